@@ -0,0 +1,84 @@
+import time
+from collections import deque
+
+
+class AccountState:
+    """
+    In-memory wallet and positions of the account
+
+    Updated from private stream topics (wallet, position, execution) and
+    replaced by REST snapshots on (re)connect, reads do not make requests.
+    State is synced only between a REST resync and the next disconnect.
+    """
+
+    def __init__(self, coin='USDT', executions_limit=1000):
+        self.coin = coin
+        self.total_wallet_balance = None
+        self.wallet_balance = None  # wallet balance of coin
+        self.positions = {}  # symbol -> position data of the exchange, only open positions
+        self.executions = deque(maxlen=executions_limit)
+        self.updated = None
+        self.resyncs = 0
+        self.synced = False
+
+    @property
+    def ready(self):
+        return self.total_wallet_balance is not None and self.wallet_balance is not None
+
+    def mark_stale(self):
+        """
+        Marks state as not synced (stream disconnected), it stays stale until next resync
+        """
+        self.synced = False
+
+    def balance(self):
+        """
+        Returns (totalWalletBalance, walletBalance of coin)
+        """
+        return self.total_wallet_balance, self.wallet_balance
+
+    def apply_wallet(self, account):
+        """
+        Applies wallet of account, same format in stream and in REST wallet-balance result
+        """
+        if account.get('totalWalletBalance'):
+            self.total_wallet_balance = float(account.get('totalWalletBalance'))
+        for coin in account.get('coin') or []:
+            if coin.get('coin') == self.coin and coin.get('walletBalance'):
+                self.wallet_balance = float(coin.get('walletBalance'))
+        self.updated = time.time()
+
+    def apply_position(self, position):
+        symbol = position.get('symbol')
+        if not float(position.get('size') or 0):
+            self.positions.pop(symbol, None)
+        else:
+            self.positions[symbol] = position
+        self.updated = time.time()
+
+    def resync(self, account, positions):
+        """
+        Replaces state with REST snapshots of wallet and positions
+        """
+        self.apply_wallet(account)
+        self.positions = {}
+        for position in positions:
+            self.apply_position(position)
+        self.resyncs += 1
+        self.synced = True
+
+    def on_message(self, data):
+        """
+        Applies private stream message (auth, subscribe and pong replies are ignored)
+        """
+        topic = data.get('topic')
+        if topic == 'wallet':
+            for account in data.get('data', []):
+                if account.get('accountType', 'UNIFIED') == 'UNIFIED':
+                    self.apply_wallet(account)
+        elif topic == 'position':
+            for position in data.get('data', []):
+                if position.get('category', 'linear') == 'linear':
+                    self.apply_position(position)
+        elif topic == 'execution':
+            self.executions.extend(data.get('data', []))
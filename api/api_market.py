@@ -7,16 +7,20 @@ import os
 import requests
 import time
 
-import aiohttp
 
 from dotenv import load_dotenv
 
+from api.rate_limit import get_scheduler, PRIORITY_ORDER, PRIORITY_MARKET, PRIORITY_BULK
+
 load_dotenv()
 
 API_KEY = str(os.getenv('test_01_bybit_api_key'))
 SECRET_KEY = str(os.getenv('test_01_bybit_secret_key'))
 
-MAIN_URL = 'https://api-testnet.bybit.com'
+# bybit_rest_url points all REST requests to another server (e.g. local simulator.py)
+REST_URL = os.getenv('bybit_rest_url')
+MAIN_URL = REST_URL or 'https://api-testnet.bybit.com'
+MARKET_URL = REST_URL or 'https://api.bybit.com'
 
 ENDPOINTS_BYBIT = {
     # trade
@@ -63,14 +67,12 @@ async def post_data(url, data, headers):
     """
     Makes asincio post request (used in post_bybit_signed)
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, data=data, headers=headers) as response:
-            return await response.json()
+    return await get_scheduler().request('POST', url, priority=PRIORITY_ORDER, data=data, headers=headers)
 
 
 async def post_bybit_signed(endpoint, API_KEY, SECRET_KEY, **kwargs):
     """
-    Sends signed post requests with aiohttp
+    Sends signed post requests through the rate limited scheduler
     """
     timestamp = int(time.time() * 1000)
     recv_wind = 5000
@@ -93,11 +95,12 @@ async def post_bybit_signed(endpoint, API_KEY, SECRET_KEY, **kwargs):
 
 
 # GET MARKET DATA
-async def get_klines_asc(symbol, interval, limit):
+async def get_klines_asc(symbol, interval, limit, start=None, base_url=MAIN_URL, end=None):
     """
     Returns list of last klines from market
+    If start (ms) is set - returns klines beginning from start, if end (ms) is set - last klines up to end
     """
-    url = MAIN_URL + ENDPOINTS_BYBIT.get('get_kline')
+    url = base_url + ENDPOINTS_BYBIT.get('get_kline')
 
     params = {
         'category': 'linear',
@@ -105,9 +108,11 @@ async def get_klines_asc(symbol, interval, limit):
         'interval': interval,
         'limit': limit,
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
-            return await response.json()
+    if start is not None:
+        params['start'] = int(start)
+    if end is not None:
+        params['end'] = int(end)
+    return await get_scheduler().request('GET', url, priority=PRIORITY_BULK, params=params)
 
 async def get_lin_perp_info_asc():
     """
@@ -117,15 +122,13 @@ async def get_lin_perp_info_asc():
     - list of trade oarams on each trading pair in format
     [{'10000000AIDOGEUSDT': {'base_coin_prec': 100.0,'price_tick': 1e-06,'minOrderQty': 100.0}}]
     """
-    url = 'https://api.bybit.com' + ENDPOINTS_BYBIT.get('instruments-info')
+    url = MARKET_URL + ENDPOINTS_BYBIT.get('instruments-info')
 
     params = {
         'category': 'linear'
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
-            data = await response.json()
+    data = await get_scheduler().request('GET', url, priority=PRIORITY_MARKET, params=params)
 
     result = data.get('result').get('list')
 
@@ -4,16 +4,29 @@ import time
 import hmac
 import hashlib
 import json
-from decimal import Decimal, ROUND_DOWN
-import aiohttp
+from urllib.parse import unquote
 from dotenv import load_dotenv
 
+from api.rate_limit import get_scheduler, PRIORITY_ORDER, PRIORITY_MARKET, PRIORITY_BULK
+from api.sessions import close_sessions
+from api.instruments import InstrumentRegistry
+from api.account import AccountState
+from api.prices import PriceCache
+from sizing import SizingEngine
+from api.ws import PrivateSocketBybit, TradeSocketBybit, OrderNotSent, json_loads
+
 load_dotenv()
 
 
 class BybitTradeClientLinear:
     MAIN_TEST = 'https://api-testnet.bybit.com'
     MAIN_REAL = 'https://api.bybit.com'
+    PRIVATE_WS_TEST = 'wss://stream-testnet.bybit.com/v5/private'
+    PRIVATE_WS_REAL = 'wss://stream.bybit.com/v5/private'
+    TRADE_WS_TEST = 'wss://stream-testnet.bybit.com/v5/trade'
+    TRADE_WS_REAL = 'wss://stream.bybit.com/v5/trade'
+
+    FAIL_MESSAGE = 'Not enough budget available, m.b. other positions ocupied trade balance'
 
     ENDPOINTS_BYBIT = {
         # trade
@@ -28,23 +41,117 @@ class BybitTradeClientLinear:
         'get_tickers': '/v5/market/tickers',
 
         # account
-        'wallet-balance': '/v5/account/wallet-balance'
+        'wallet-balance': '/v5/account/wallet-balance',
+        'position-list': '/v5/position/list',
     }
 
     # ok
-    def __init__(self, api_key, secret_key, testnet=True, risk_limit=0.8, tp_rate=0.05, sl_rate=0.03):
+    def __init__(self, api_key, secret_key, testnet=True, risk_limit=0.8, tp_rate=0.05, sl_rate=0.03,
+                 instruments_ttl=3600, price_max_age=60, trade_ws_url=None):
         self.api_key = api_key
         self.secret_key = secret_key
-        self.main_url = self.MAIN_TEST if testnet else self.MAIN_REAL
+        # exchange urls may be replaced with env vars (e.g. to run against local simulator.py)
+        self.main_url = os.getenv('bybit_rest_url') or (self.MAIN_TEST if testnet else self.MAIN_REAL)
+        self.private_ws_url = os.getenv('bybit_ws_private_url') or (
+            self.PRIVATE_WS_TEST if testnet else self.PRIVATE_WS_REAL
+        )
+        if trade_ws_url is None:
+            trade_ws_url = os.getenv('bybit_ws_trade_url') or (self.TRADE_WS_TEST if testnet else self.TRADE_WS_REAL)
+        self.trade_ws_url = trade_ws_url
         self.risk_limit = risk_limit
         self.tp_rate = tp_rate
         self.sl_rate = sl_rate
         self.start_budget = None
+        # precision of instruments, loaded once and refreshed in background
+        self.instruments = InstrumentRegistry(self.get_lin_perp_info_asc, ttl=instruments_ttl)
+        # quantity and TP / SL rounding in integer steps of instruments
+        self.sizing = SizingEngine(self.instruments)
+        # wallet and positions from private stream, see start_account_stream
+        self.account = AccountState(coin='USDT')
+        self.private_socket = None
+        self.private_task = None
+        # orders over trade websocket, see start_trade_stream
+        self.trade_socket = None
+        self.trade_task = None
+        # last prices, fed from kline stream, bulk tickers snapshot as fallback
+        self.prices = PriceCache(self.get_tickers, max_age=price_max_age)
         if testnet:
             print('TESTNET MODE')
         else:
             print('BE CAREFULL PRODUCTION MODE')
 
+    async def close(self):
+        """
+        Closes pooled HTTP connections of the process, call on shutdown
+        """
+        self.instruments.stop()
+        for task in (self.private_task, self.trade_task):
+            if task is not None:
+                task.cancel()
+        self.private_task = self.trade_task = None
+        await close_sessions()
+
+    def start_account_stream(self):
+        """
+        Starts private websocket which keeps self.account up to date
+        Account is resynced with REST after every (re)connect
+        """
+        if self.private_task is None or self.private_task.done():
+            self.private_socket = PrivateSocketBybit(
+                self.private_ws_url, self.api_key, self.secret_key,
+                on_message=self._on_private_message, on_ready=self._on_private_ready,
+                on_disconnect=self._on_private_disconnect
+            )
+            self.private_task = asyncio.create_task(self.private_socket.connect())
+        return self.private_task
+
+    def start_trade_stream(self):
+        """
+        Starts trade websocket, orders go through it while it is connected
+        """
+        if self.trade_task is None or self.trade_task.done():
+            self.trade_socket = TradeSocketBybit(self.trade_ws_url, self.api_key, self.secret_key)
+            self.trade_task = asyncio.create_task(self.trade_socket.connect())
+        return self.trade_task
+
+    async def place_order(self, **kwargs):
+        """
+        Creates order over trade websocket, over REST if websocket is down
+        REST is used only if the order was not sent to websocket at all
+        """
+        if self.trade_socket is not None and self.trade_socket.ready:
+            # websocket orders share the order rate limit with REST orders, but take no HTTP slot
+            await get_scheduler().take_tokens(self.ENDPOINTS_BYBIT['place_order'], PRIORITY_ORDER)
+            try:
+                return await self.trade_socket.create_order(**kwargs)
+            except OrderNotSent as e:
+                print(f"{e}, order is sent over REST")
+        return await self.post_bybit_signed('place_order', **kwargs)
+
+    async def _on_private_message(self, ws, message):
+        self.account.on_message(json_loads(message.data))
+
+    async def _on_private_ready(self, socket):
+        await self.resync_account()
+
+    async def _on_private_disconnect(self, socket):
+        # updates were missed while disconnected, state is not used until resync after reconnect
+        self.account.mark_stale()
+
+    async def resync_account(self):
+        wallet, positions = await asyncio.gather(self.get_wallet_balance(coin='USDT'), self.get_positions())
+        self.account.resync(wallet, positions)
+
+    async def get_balance(self):
+        """
+        Returns (totalWalletBalance, USDT walletBalance), from local account state if it is streamed
+        and resynced after the last connect
+        """
+        streamed = self.private_socket is not None and self.private_socket.connected
+        if not (streamed and self.account.synced and self.account.ready):
+            self.account.apply_wallet(await self.get_wallet_balance(coin='USDT'))
+        return self.account.balance()
+
     # start_budget will appear only after calling this function
     async def initialize_start_budget(self):
         balance = await self.get_wallet_balance(coin='USDT')
@@ -64,9 +171,7 @@ class BybitTradeClientLinear:
 
     @staticmethod
     async def post_data(url, data, headers):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=data, headers=headers) as response:
-                return await response.json()
+        return await get_scheduler().request('POST', url, priority=PRIORITY_ORDER, data=data, headers=headers)
 
     async def post_bybit_signed(self, endpoint, **kwargs):
         timestamp = int(time.time() * 1000)
@@ -93,52 +198,27 @@ class BybitTradeClientLinear:
             'interval': interval,
             'limit': limit,
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                return await response.json()
+        return await get_scheduler().request('GET', url, priority=PRIORITY_BULK, params=params)
 
     # ok
     async def create_market_linear_buy(self, symbol, quantity, takeProfit, stopLoss):
-        return await self.post_bybit_signed('place_order',
-                                            orderType='Market',
-                                            category='linear',
-                                            symbol=symbol,
-                                            side='Buy',
-                                            qty=quantity,
-                                            takeProfit=takeProfit,
-                                            stopLoss=stopLoss)
+        return await self.place_order(orderType='Market',
+                                      category='linear',
+                                      symbol=symbol,
+                                      side='Buy',
+                                      qty=quantity,
+                                      takeProfit=takeProfit,
+                                      stopLoss=stopLoss)
 
     # ok
     async def create_market_linear_sell(self, symbol, quantity, takeProfit='50000', stopLoss='70000'):
-        return await self.post_bybit_signed('place_order',
-                                            orderType='Market',
-                                            category='linear',
-                                            symbol=symbol,
-                                            side='Sell',
-                                            qty=quantity,
-                                            takeProfit=takeProfit,
-                                            stopLoss=stopLoss)
-
-    @staticmethod
-    def calculate_purchase_volume(sum_amount, price, min_volume, tick):
-        sum_amount = Decimal(str(sum_amount))
-        price = Decimal(str(price))
-        min_volume = Decimal(str(min_volume))
-        tick = Decimal(str(tick))
-
-        volume = sum_amount / price
-        rounded_volume = (volume // tick) * tick
-
-        if rounded_volume < min_volume:
-            return -1
-
-        return float(rounded_volume.quantize(tick, rounding=ROUND_DOWN))
-
-    @staticmethod
-    def round_price(price, tick_size):
-        price = Decimal(str(price))
-        tick_size = Decimal(str(tick_size))
-        return float((price // tick_size) * tick_size)
+        return await self.place_order(orderType='Market',
+                                      category='linear',
+                                      symbol=symbol,
+                                      side='Sell',
+                                      qty=quantity,
+                                      takeProfit=takeProfit,
+                                      stopLoss=stopLoss)
 
     async def get_wallet_balance(self, coin=None):
         url = self.main_url + '/v5/account/wallet-balance'
@@ -152,94 +232,112 @@ class BybitTradeClientLinear:
         if coin:
             params['coin'] = coin
         headers['X-BAPI-SIGN'] = self.gen_signature_get(params, timestamp, self.api_key, self.secret_key)
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers, params=params) as response:
-                data = await response.json()
+        data = await get_scheduler().request('GET', url, priority=PRIORITY_ORDER, headers=headers, params=params)
         return data.get('result').get('list')[0]
 
+    async def get_positions(self, settle_coin='USDT'):
+        """
+        Returns all open linear positions, pages of 200 are followed by nextPageCursor
+        """
+        url = self.main_url + self.ENDPOINTS_BYBIT['position-list']
+        positions = []
+        cursor = None
+        while True:
+            params = {'category': 'linear', 'settleCoin': settle_coin, 'limit': 200}
+            if cursor:
+                params['cursor'] = cursor
+            timestamp = str(int(time.time() * 1000))
+            headers = {
+                'X-BAPI-API-KEY': self.api_key,
+                'X-BAPI-TIMESTAMP': timestamp,
+                'X-BAPI-RECV-WINDOW': '5000',
+                'X-BAPI-SIGN': self.gen_signature_get(params, timestamp, self.api_key, self.secret_key),
+            }
+            data = await get_scheduler().request('GET', url, priority=PRIORITY_MARKET, headers=headers, params=params)
+            result = data.get('result')
+            positions.extend(result.get('list'))
+            # cursor comes url-encoded, it is signed and sent decoded like the other params
+            cursor = unquote(result.get('nextPageCursor') or '')
+            if not cursor or not result.get('list'):
+                return positions
+
+    async def get_tickers(self):
+        """
+        Returns tickers of all linear symbols in one request
+        """
+        url = self.main_url + self.ENDPOINTS_BYBIT['get_tickers']
+        params = {'category': 'linear'}
+        data = await get_scheduler().request('GET', url, priority=PRIORITY_ORDER, params=params)
+        return data.get('result').get('list')
+
     async def get_pair_price_asc(self, symbol):
-        url = self.main_url + '/v5/market/tickers'
+        try:
+            price = await self.prices.price(symbol)
+        except Exception as e:
+            print(f"Tickers snapshot failed, price of {symbol} is requested separately: {e}")
+            price = None
+        if price is not None:
+            return price
+        url = self.main_url + self.ENDPOINTS_BYBIT['get_tickers']
         params = {
             'category': 'linear',
             'symbol': symbol
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                data = await response.json()
+        data = await get_scheduler().request('GET', url, priority=PRIORITY_ORDER, params=params)
         return data.get('result').get('list')[0].get('lastPrice')
 
     ########## combined trade functions ##########
     ########## START  ###########
-    async def place_long(self, pair):
-        if self.start_budget is None:
-            await self.initialize_start_budget()
-
-        # refactor to task-gather
-        balance = await self.get_wallet_balance(coin='USDT')
-        para = await self.get_lin_perp_info_asc()
-        para = para[2].get(pair)
-        current_price = await self.get_pair_price_asc(pair)
-        price_tick = para.get('price_tick')
-        total_balance = float(balance.get('totalWalletBalance'))
-        avail_usdt = float(balance.get('coin')[0].get('walletBalance'))
-
-        quantity = self.calculate_purchase_volume(avail_usdt, current_price, para.get('minOrderQty'),
-                                                  para.get('base_coin_prec'))
-        fail_message = 'Not enough budget available, m.b. other positions ocupied trade balance'
-        success_message = 'Position has been placed successfully'
-        if quantity == -1:
-            print(fail_message)
-            return
-        if total_balance <= self.risk_limit * self.start_budget:
-            print('Budget drop to minimum, stop trading!!!')
-            return
+    async def place_long(self, pair, budget=None):
+        return await self.place_position(pair, 'Buy', budget)
 
-        tp_price = self.round_price((float(current_price) * (1 + self.tp_rate)), price_tick)
-        sl_price = self.round_price((float(current_price) * (1 - self.sl_rate)), price_tick)
-
-        res = await self.create_market_linear_buy(pair, quantity, tp_price, sl_price)
-        if res.get('retMsg') == 'ab not enough for new order':
-            print(fail_message)
-        if res.get('retMsg') == 'OK':
-            print(success_message)
+    async def place_short(self, pair, budget=None):
+        return await self.place_position(pair, 'Sell', budget)
 
-    async def place_short(self, pair):
+    async def place_position(self, pair, side, budget=None):
+        """
+        Opens market position of side ('Buy' / 'Sell') with TP / SL
+        Position is sized from budget (USDT), from the whole available balance if budget is None
+        """
         if self.start_budget is None:
             await self.initialize_start_budget()
 
-        # refactor to task-gather
-        balance = await self.get_wallet_balance(coin='USDT')
-        para = await self.get_lin_perp_info_asc()
-        para = para[2].get(pair)
+        # balance from local account state (private stream), no request
+        total_balance, avail_usdt = await self.get_balance()
+        if budget is not None:
+            avail_usdt = min(avail_usdt, budget)
+        if not self.instruments:
+            await self.instruments.refresh()
+        if pair not in self.instruments:
+            print(f'No instrument info for {pair}')
+            return
         current_price = await self.get_pair_price_asc(pair)
 
-        price_tick = para.get('price_tick')
-        total_balance = float(balance.get('totalWalletBalance'))
-        avail_usdt = float(balance.get('coin')[0].get('walletBalance'))
-
-        quantity = self.calculate_purchase_volume(avail_usdt, current_price, para.get('minOrderQty'),
-                                                  para.get('base_coin_prec'))
-        fail_message = 'Not enough budget available, m.b. other positions ocupied trade balance'
-        success_message = 'Position has been placed successfully'
-        if quantity == -1:
-            print(fail_message)
+        fields = self.sizing.order_fields(pair, side, avail_usdt, current_price, self.tp_rate, self.sl_rate)
+        if fields is None:
+            print(self.FAIL_MESSAGE)
             return
         if total_balance <= self.risk_limit * self.start_budget:
             print('Budget drop to minimum, stop trading!!!')
             return
+        return await self.submit_order(fields)
+
+    async def submit_order(self, fields):
+        """
+        Sends market order of sizing.OrderFields
+        """
+        if fields.side == 'Buy':
+            res = await self.create_market_linear_buy(fields.symbol, fields.qty, fields.take_profit, fields.stop_loss)
+        else:
+            res = await self.create_market_linear_sell(fields.symbol, fields.qty, fields.take_profit, fields.stop_loss)
 
-        tp_price = self.round_price((float(current_price) * (1 - self.tp_rate)), price_tick)
-        sl_price = self.round_price((float(current_price) * (1 + self.sl_rate)), price_tick)
-
-        res = await self.create_market_linear_sell(pair, quantity, tp_price, sl_price)
         if res.get('retMsg') == 'ab not enough for new order':
-            print(fail_message)
+            print(self.FAIL_MESSAGE)
+        elif res.get('retMsg') == 'OK':
+            print('Position has been placed successfully')
         else:
             print(res)
-        if res.get('retMsg') == 'OK':
-            print(success_message)
-
-
+        return res
 
         ########## END  ###########
         ########## combined trade functions ##########
@@ -247,9 +345,7 @@ class BybitTradeClientLinear:
     async def get_lin_perp_info_asc(self):
         url = self.main_url + self.ENDPOINTS_BYBIT.get('instruments-info')
         params = {'category': 'linear'}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                data = await response.json()
+        data = await get_scheduler().request('GET', url, priority=PRIORITY_MARKET, params=params)
         result = data.get('result').get('list')
         pairs_params = [element for element in result if
                         element.get('quoteCoin') == 'USDT' and element.get('status') == 'Trading' and element.get(
@@ -279,8 +375,11 @@ async def main():
                                     testnet=True, risk_limit=0.8,
                                     tp_rate=0.05, sl_rate=0.03)
 
-    await client.initialize_start_budget()
-    await client.place_long(symbol)
+    try:
+        await client.initialize_start_budget()
+        await client.place_long(symbol)
+    finally:
+        await client.close()
     #await client.place_short(symbol)
     #res = await client.get_klines_asc('BTCUSDT', 5, 2)
     #print(res)
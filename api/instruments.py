@@ -0,0 +1,72 @@
+import asyncio
+import time
+from collections import namedtuple
+
+
+# precision of one instrument, values as in get_lin_perp_info_asc short_params
+Instrument = namedtuple('Instrument', ['base_coin_prec', 'price_tick', 'minOrderQty'])
+
+
+class InstrumentRegistry:
+    """
+    Precision table of linear instruments by symbol (qty step, price tick, min order qty)
+
+    Table is loaded once (or seeded with already fetched short_params) and refreshed
+    in a background task every `ttl` seconds, lookups do not make requests.
+    `load` - coroutine function returning get_lin_perp_info_asc result.
+    """
+
+    def __init__(self, load, ttl=3600):
+        self.load = load
+        self.ttl = ttl
+        self.instruments = {}
+        self.updated = None
+        self.task = None
+
+    def seed(self, short_params):
+        """
+        Replaces table with short_params {'BTCUSDT': {'base_coin_prec': 0.001, 'price_tick': 0.1, 'minOrderQty': 0.001}}
+        """
+        self.instruments = {
+            symbol: Instrument(params['base_coin_prec'], params['price_tick'], params['minOrderQty'])
+            for symbol, params in short_params.items()
+        }
+        self.updated = time.time()
+
+    def get(self, symbol):
+        """
+        Returns Instrument of symbol or None if symbol is unknown
+        """
+        return self.instruments.get(symbol)
+
+    def __contains__(self, symbol):
+        return symbol in self.instruments
+
+    def __len__(self):
+        return len(self.instruments)
+
+    async def refresh(self):
+        info = await self.load()
+        self.seed(info[2])
+        return self
+
+    def start(self):
+        """
+        Starts background refresh, previous table stays in use if refresh fails
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return self.task
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Failed to refresh instruments info: {e}")
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+
+class PriceCache:
+    """
+    Last prices of symbols
+
+    Fed continuously with kline closes from the stream, bulk ticker snapshot
+    (one request for all linear symbols) fills missing and stale prices,
+    concurrent misses share one snapshot request.
+    `load` - coroutine function returning tickers list of /v5/market/tickers.
+    """
+
+    def __init__(self, load, max_age=60):
+        self.load = load
+        self.max_age = max_age
+        self.prices = {}  # symbol -> (price, monotonic time of update)
+        self.loading = None  # snapshot task in flight
+        self.snapshots = 0
+        self.misses = 0
+
+    def update(self, symbol, price):
+        self.prices[symbol] = (float(price), time.monotonic())
+
+    def get(self, symbol, max_age=None):
+        """
+        Returns price of symbol or None if it is unknown or older than max_age seconds
+        """
+        item = self.prices.get(symbol)
+        if item is None:
+            return None
+        max_age = self.max_age if max_age is None else max_age
+        if max_age is not None and time.monotonic() - item[1] > max_age:
+            return None
+        return item[0]
+
+    async def snapshot(self):
+        """
+        Updates prices of all symbols from one bulk tickers request
+        If a snapshot is already in flight, waits for it instead of sending another one
+        """
+        if self.loading is None:
+            self.loading = asyncio.create_task(self._snapshot())
+        # shield - cancelled caller does not cancel request shared with other callers
+        await asyncio.shield(self.loading)
+
+    async def _snapshot(self):
+        try:
+            tickers = await self.load()
+            now = time.monotonic()
+            for ticker in tickers:
+                if ticker.get('lastPrice'):
+                    self.prices[ticker.get('symbol')] = (float(ticker.get('lastPrice')), now)
+            self.snapshots += 1
+        finally:
+            self.loading = None
+
+    async def price(self, symbol):
+        """
+        Returns cached price, takes bulk snapshot if price is missing or stale
+        """
+        price = self.get(symbol)
+        if price is None:
+            self.misses += 1
+            await self.snapshot()
+            price = self.get(symbol)
+        return price
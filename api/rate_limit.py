@@ -0,0 +1,258 @@
+import asyncio
+import os
+import time
+from itertools import count
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from api.sessions import get_session
+
+# priority lanes, lower value is served first
+PRIORITY_ORDER = 0  # order placement and requests on its path
+PRIORITY_MARKET = 1
+PRIORITY_BULK = 2  # history downloads
+
+# requests per second by endpoint (UID limits of the exchange)
+ENDPOINT_LIMITS = {
+    '/v5/order/create': 10,
+    '/v5/order/cancel': 10,
+    '/v5/order/realtime': 50,
+    '/v5/account/wallet-balance': 50,
+}
+
+# IP limit of the exchange - 600 requests in 5 seconds for all endpoints
+IP_RATE = 120
+IP_CAPACITY = 600
+
+RATE_LIMIT_CODES = {10006, 10018}  # too many visits / exceeded IP rate limit
+
+
+class TokenBucket:
+    """
+    Token bucket with rate tokens per second and capacity burst
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def delay(self, reserve=0):
+        """
+        Returns seconds until a token is available while keeping `reserve` tokens for higher priorities
+        """
+        now = self._refill()
+        if now < self.paused_until:
+            return self.paused_until - now
+        need = 1 + reserve - self.tokens
+        return need / self.rate if need > 0 else 0
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """
+        Blocks bucket for seconds (exchange reported limit is reached)
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class RequestScheduler:
+    """
+    Sends REST requests within exchange rate limits
+
+    - every request takes a token from the IP bucket and from its endpoint bucket
+    - at most max_concurrency requests are in flight
+    - waiting requests are served by priority, lower lanes can not use the last `reserve` IP tokens
+      and the last `reserve_slots` concurrency slots, so orders never wait behind bulk requests
+    - rate limit headers and codes pause the buckets, throttled requests are retried with backoff
+    """
+
+    def __init__(self, max_concurrency=50, ip_rate=IP_RATE, ip_capacity=IP_CAPACITY,
+                 endpoint_limits=None, reserve=20, reserve_slots=5, max_retries=3, backoff=1.0):
+        self.max_concurrency = max_concurrency
+        self.reserve_slots = min(reserve_slots, max_concurrency - 1)
+        self.ip_bucket = TokenBucket(ip_rate, ip_capacity)
+        self.endpoint_limits = ENDPOINT_LIMITS if endpoint_limits is None else endpoint_limits
+        self.endpoint_buckets = {}
+        self.reserve = reserve
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.active = 0
+        self.waiting = []  # (priority, number, endpoint, future, takes slot)
+        self.numbers = count()
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+        self.throttled = 0
+
+    def _endpoint_bucket(self, endpoint):
+        """
+        Returns bucket of endpoint, endpoints without own limit get a bucket only to be paused
+        """
+        bucket = self.endpoint_buckets.get(endpoint)
+        if bucket is None:
+            rate = self.endpoint_limits.get(endpoint)
+            if rate is None:
+                # never limits more than the IP bucket, only pauses are applied to it
+                bucket = TokenBucket(self.ip_bucket.rate, self.ip_bucket.capacity)
+            else:
+                bucket = TokenBucket(rate)
+            self.endpoint_buckets[endpoint] = bucket
+        return bucket
+
+    def _buckets(self, endpoint):
+        if endpoint in self.endpoint_limits or endpoint in self.endpoint_buckets:
+            return [self.ip_bucket, self._endpoint_bucket(endpoint)]
+        return [self.ip_bucket]
+
+    async def acquire(self, endpoint, priority, slot=True):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append((priority, next(self.numbers), endpoint, future, slot))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        self.wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # slot was granted but caller is cancelled - give it back
+            if slot and future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    async def take_tokens(self, endpoint, priority):
+        """
+        Waits for rate limit tokens of endpoint without taking a concurrency slot
+        (requests sent another way, e.g. orders over websocket)
+        """
+        await self.acquire(endpoint, priority, slot=False)
+
+    def release(self):
+        self.active -= 1
+        self.wakeup.set()
+
+    def _grant(self):
+        """
+        Lets through the first waiting request by priority which limits allow right now
+        Returns 0 if request was let through, otherwise seconds to wait (None - until wakeup)
+        """
+        timeout = None
+        for item in sorted(self.waiting, key=lambda item: item[:2]):
+            priority, _, endpoint, future, slot = item
+            if future.done():
+                self.waiting.remove(item)
+                continue
+            # the last reserve_slots slots are kept for the order lane
+            slots = self.max_concurrency - (self.reserve_slots if priority > PRIORITY_ORDER else 0)
+            if slot and self.active >= slots:
+                continue
+            buckets = self._buckets(endpoint)
+            reserve = self.reserve if priority > PRIORITY_ORDER else 0
+            delay = max(bucket.delay(reserve if bucket is self.ip_bucket else 0) for bucket in buckets)
+            if delay <= 0:
+                self.waiting.remove(item)
+                for bucket in buckets:
+                    bucket.take()
+                if slot:
+                    self.active += 1
+                future.set_result(None)
+                return 0
+            timeout = delay if timeout is None else min(timeout, delay)
+        return timeout
+
+    async def _dispatch(self):
+        while True:
+            timeout = self._grant()
+            if timeout == 0:
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _apply_limit_headers(self, endpoint, headers):
+        # X-Bapi-Limit-Status - requests left for endpoint until X-Bapi-Limit-Reset-Timestamp
+        remaining = headers.get('X-Bapi-Limit-Status')
+        reset = headers.get('X-Bapi-Limit-Reset-Timestamp')
+        if remaining is not None and reset is not None and int(remaining) <= 0:
+            seconds = int(reset) / 1000 - time.time()
+            if seconds > 0:
+                self._endpoint_bucket(endpoint).pause(seconds)
+
+    def _throttle(self, endpoint, status, headers, attempt):
+        self.throttled += 1
+        seconds = self.backoff * 2 ** attempt
+        reset = headers.get('X-Bapi-Limit-Reset-Timestamp')
+        if reset is not None:
+            seconds = max(seconds, int(reset) / 1000 - time.time())
+        # 403 - IP limit, other codes - endpoint limit
+        bucket = self.ip_bucket if status == 403 else self._endpoint_bucket(endpoint)
+        bucket.pause(seconds)
+        print(f"Rate limit reached on {endpoint}, pause {seconds:.1f} s")
+
+    @staticmethod
+    async def _send(method, url, **kwargs):
+        # shared session of the process - connections are reused between requests
+        async with get_session().request(method, url, **kwargs) as response:
+            try:
+                data = await response.json(content_type=None)
+            except ValueError:
+                data = {'retCode': response.status, 'retMsg': await response.text()}
+            return response.status, response.headers, data
+
+    async def request(self, method, url, priority=PRIORITY_MARKET, **kwargs):
+        """
+        Sends request when limits allow, returns decoded json response
+        Network errors are retried only for GET requests (POST may be already executed)
+        """
+        endpoint = urlsplit(url).path
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            await self.acquire(endpoint, priority)
+            try:
+                status, headers, data = await self._send(method, url, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if method != 'GET' or last_attempt:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+                continue
+            finally:
+                self.release()
+
+            self._apply_limit_headers(endpoint, headers)
+            ret_code = data.get('retCode') if isinstance(data, dict) else None
+            if (status == 403 or ret_code in RATE_LIMIT_CODES) and not last_attempt:
+                self._throttle(endpoint, status, headers, attempt)
+                continue
+            if status >= 500 and method == 'GET' and not last_attempt:
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+                continue
+            return data
+
+
+_scheduler = None
+_scheduler_pid = None
+
+
+def get_scheduler():
+    """
+    Returns process-wide request scheduler
+    """
+    global _scheduler, _scheduler_pid
+    if _scheduler is None or _scheduler_pid != os.getpid():
+        _scheduler = RequestScheduler(
+            max_concurrency=int(os.getenv('rest_max_concurrency', 50)),
+        )
+        _scheduler_pid = os.getpid()
+    return _scheduler
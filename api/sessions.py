@@ -0,0 +1,45 @@
+import asyncio
+import os
+
+import aiohttp
+
+
+HTTP_POOL_SIZE = int(os.getenv('http_pool_size', 100))
+HTTP_KEEPALIVE = float(os.getenv('http_keepalive', 120))
+HTTP_TIMEOUT = float(os.getenv('http_timeout', 10))
+DNS_CACHE_TTL = 300
+
+_sessions = {}  # (pid, event loop) -> session
+
+
+def get_session():
+    """
+    Returns long-lived HTTP session of the current process and event loop
+
+    Session keeps a pool of keep-alive connections with cached DNS,
+    so requests reuse warm TCP/TLS connections instead of opening new ones.
+    """
+    key = (os.getpid(), asyncio.get_running_loop())
+    session = _sessions.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        )
+        _sessions[key] = session
+    return session
+
+
+async def close_sessions():
+    """
+    Closes HTTP sessions of the current process and event loop (shutdown hook)
+    """
+    key = (os.getpid(), asyncio.get_running_loop())
+    session = _sessions.pop(key, None)
+    if session is not None and not session.closed:
+        await session.close()
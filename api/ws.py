@@ -1,44 +1,357 @@
 import asyncio
+import hashlib
+import hmac
+import math
+import time
 import aiohttp
 import json
 import traceback
+from collections import namedtuple
+from itertools import count
+
+from api.api_market import MARKET_URL, get_klines_asc
+from utils import interval_to_ms
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+# confirmed kline record, field order matches transport.pack_kline
+Kline = namedtuple('Kline', ['start', 'symbol', 'open', 'close', 'high', 'low', 'volume'])
+
+
+class KlineDecoder:
+    """
+    Decodes kline frames into Kline records
+
+    Frames without confirmed klines (updates of the current candle, pongs, subscribe replies)
+    are rejected by substring checks before full json parsing.
+    """
+
+    def __init__(self):
+        self.dropped = 0
+        self.decoded = 0
+        self.errors = 0
+
+    def decode(self, raw):
+        """
+        Returns list of confirmed klines from frame (empty list if frame is dropped)
+        """
+        if isinstance(raw, bytes):
+            raw = raw.decode()
+        if '"confirm"' not in raw or ('"confirm":true' not in raw and '"confirm":false' in raw):
+            self.dropped += 1
+            return []
+        try:
+            data = json_loads(raw)
+            symbol = data['topic'].rsplit('.', 1)[-1]
+            klines = [
+                Kline(int(ohlc['start']), symbol, float(ohlc['open']), float(ohlc['close']),
+                      float(ohlc['high']), float(ohlc['low']), float(ohlc['volume']))
+                for ohlc in data['data'] if ohlc.get('confirm') is True
+            ]
+        except (ValueError, KeyError, TypeError) as e:
+            self.errors += 1
+            print(f"Failed to decode kline frame: {e}")
+            return []
+        if klines:
+            self.decoded += len(klines)
+        else:
+            self.dropped += 1
+        return klines
+
+    def stats(self):
+        return {'dropped': self.dropped, 'decoded': self.decoded, 'errors': self.errors}
+
+
+class KlineBackfill:
+    """
+    Forwards confirmed klines to on_kline and fills gaps after reconnects
+
+    Remembers last confirmed start per symbol. After reconnect the missing closed klines
+    are fetched over REST (concurrently, within the scheduler limits) and forwarded in order,
+    live klines of the symbol are held until its backfill is done.
+    """
+
+    def __init__(self, on_kline):
+        self.on_kline = on_kline
+        self.last_start = {}
+        self.pending = {}  # symbol -> live klines held while backfill runs
+        self.tasks = set()
+        self.filled = 0
+
+    async def emit(self, kline):
+        held = self.pending.get(kline.symbol)
+        if held is not None:
+            held.append(kline)
+            return
+        await self._forward(kline)
+
+    async def _forward(self, kline):
+        # skip klines already forwarded (overlap of backfill and live stream)
+        if kline.start <= self.last_start.get(kline.symbol, -1):
+            return
+        self.last_start[kline.symbol] = kline.start
+        await self.on_kline(kline)
+
+    def start(self, topics):
+        """
+        Starts backfill of topics in background task, returns the task or None if nothing is missing
+
+        Symbols with a gap are marked pending at once, before the caller subscribes to them,
+        so a live kline handled before the REST fetch is held and can not hide the gap.
+        """
+        now_ms = time.time() * 1000
+        targets = []
+        for topic in topics:
+            _, interval, symbol = topic.split('.', 2)
+            last = self.last_start.get(symbol)
+            step = interval_to_ms(interval)
+            if last is None or step is None or symbol in self.pending:
+                continue
+            # next candle after last one has closed already
+            if last + 2 * step <= now_ms:
+                self.pending[symbol] = []
+                targets.append((symbol, interval, last, step))
+        if not targets:
+            return None
+        print(f"Backfill of {len(targets)} symbols after reconnect")
+        task = asyncio.create_task(self._fill(targets, now_ms))
+        # task reference is kept until it is done, otherwise it may be garbage collected
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def fill(self, topics):
+        """
+        Fetches and forwards klines closed since last confirmed start for each topic
+        """
+        task = self.start(topics)
+        if task is not None:
+            await task
+
+    async def _fill(self, targets, now_ms):
+        await asyncio.gather(*(self._fill_symbol(*target, now_ms) for target in targets))
+
+    async def _fill_symbol(self, symbol, interval, last, step, now_ms):
+        try:
+            missing = int((now_ms - last) // step)
+            # klines are taken from the main exchange like the stream, requests go through the shared scheduler
+            response = await get_klines_asc(symbol, interval, min(missing + 1, 1000), start=last + step,
+                                            base_url=MARKET_URL)
+            rows = response.get('result', {}).get('list', [])
+            klines = sorted(
+                Kline(int(row[0]), symbol, float(row[1]), float(row[4]), float(row[2]), float(row[3]), float(row[5]))
+                for row in rows if last < int(row[0]) and int(row[0]) + step <= now_ms
+            )
+            for kline in klines:
+                await self._forward(kline)
+            self.filled += len(klines)
+        except Exception as e:
+            print(f"Backfill failed for {symbol}: {e}")
+        finally:
+            held = self.pending[symbol]
+            while held:
+                await self._forward(held.pop(0))
+            del self.pending[symbol]
+
+
+class ConnectionHealth:
+    """
+    Ping round trip time, message rate and staleness of one websocket connection
+    """
+
+    def __init__(self):
+        self.connected_at = None
+        self.last_message = None
+        self.last_confirmed = None
+        self.messages = 0
+        self.confirmed = 0
+        self.message_rate = 0.0
+        self.rtt = None
+        self.rtt_avg = None
+        self.reconnects = 0
+        self.forced_reconnects = 0
+        self.pings = {}  # req_id -> send time
+        self._rate_mark = (time.monotonic(), 0)
+
+    def on_connect(self):
+        now = time.monotonic()
+        if self.connected_at is not None:
+            self.reconnects += 1
+        self.connected_at = now
+        self.last_message = now
+        self.pings.clear()
+        self._rate_mark = (now, self.messages)
+
+    def on_message(self):
+        self.messages += 1
+        self.last_message = time.monotonic()
+
+    def on_confirmed(self, amount):
+        self.confirmed += amount
+        self.last_confirmed = time.monotonic()
+
+    def on_ping(self, req_id):
+        self.pings[req_id] = time.monotonic()
+
+    def on_pong(self, req_id):
+        sent = self.pings.pop(req_id, None)
+        if sent is None:
+            return
+        self.rtt = time.monotonic() - sent
+        self.rtt_avg = self.rtt if self.rtt_avg is None else 0.8 * self.rtt_avg + 0.2 * self.rtt
+
+    def update_rate(self):
+        now = time.monotonic()
+        mark_time, mark_messages = self._rate_mark
+        if now > mark_time:
+            self.message_rate = (self.messages - mark_messages) / (now - mark_time)
+        self._rate_mark = (now, self.messages)
+
+    def silence(self):
+        """
+        Returns seconds since last received data frame (pongs are not counted)
+        """
+        if self.last_message is None:
+            return None
+        return time.monotonic() - self.last_message
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {
+            'rtt_ms': None if self.rtt is None else round(self.rtt * 1000, 2),
+            'rtt_avg_ms': None if self.rtt_avg is None else round(self.rtt_avg * 1000, 2),
+            'messages_per_second': round(self.message_rate, 2),
+            'messages': self.messages,
+            'confirmed': self.confirmed,
+            'since_last_message': None if self.last_message is None else round(now - self.last_message, 3),
+            'since_last_confirmed': None if self.last_confirmed is None else round(now - self.last_confirmed, 3),
+            'reconnects': self.reconnects,
+            'forced_reconnects': self.forced_reconnects,
+        }
 
 
 class SocketBybit:
 
-    def __init__(self, url, params=None, on_message=None):
+    def __init__(self, url, params=None, on_message=None, subscribe_chunk=10, on_disconnect=None,
+                 on_kline=None, backfill=None, ping_interval=20, stale_after=60):
         self.url = url
-        self.params = params
+        self.params = list(params) if params is not None else []
+        self.subscribe_chunk = subscribe_chunk
+        self.on_disconnect = on_disconnect
+        self.ws = None
         if on_message is not None:
             self.on_message = on_message
+        # if on_kline is set, frames go through decoder and only confirmed klines are passed on
+        self.on_kline = on_kline
+        self.decoder = KlineDecoder()
+        if backfill is None and on_kline is not None:
+            backfill = KlineBackfill(on_kline)
+        self.backfill = backfill
+        self.connections = 0
+        self.ping_interval = ping_interval
+        self.stale_after = stale_after
+        self.health = ConnectionHealth()
+        self._ping_ids = count(100001)
+
+    @property
+    def connected(self):
+        return self.ws is not None and not self.ws.closed
 
     async def connect(self):
         while True:
             try:
                 async with aiohttp.ClientSession() as session:
                     async with session.ws_connect(self.url) as ws:
+                        self.ws = ws
+                        self.health.on_connect()
+                        # missed klines are marked before subscribing, live klines of these pairs wait for backfill
+                        if self.connections > 0 and self.backfill is not None:
+                            self.backfill.start(list(self.params))
                         await self.on_open(ws)
+                        self.connections += 1
+                        # one heartbeat per connection, cancelled when connection is left
                         heartbeat_task = asyncio.create_task(self.send_heartbeat(ws))
-                        while True:
-                            try:
-                                message = await ws.receive()
-                                if message.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
-                                    raise ConnectionError("WebSocket connection closed or error occurred")
-                                elif message.type == aiohttp.WSMsgType.TEXT:
-                                    await self.on_message(ws, message)
-                            except Exception as e:
-                                await self.on_error(ws, e)
-                                await asyncio.sleep(5)
-                                break  # Exit the inner loop to reconnect
+                        try:
+                            while True:
+                                try:
+                                    message = await ws.receive()
+                                    if message.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSING,
+                                                        aiohttp.WSMsgType.ERROR):
+                                        raise ConnectionError("WebSocket connection closed or error occurred")
+                                    elif message.type == aiohttp.WSMsgType.TEXT:
+                                        await self.handle_text(ws, message)
+                                except Exception as e:
+                                    await self.on_error(ws, e)
+                                    await self._handle_disconnect()
+                                    await asyncio.sleep(5)
+                                    break  # Exit the inner loop to reconnect
+                        finally:
+                            heartbeat_task.cancel()
             except Exception as e:
                 print(f"Connection failed: {e}")
+                await self._handle_disconnect()
                 await asyncio.sleep(1)  # Wait before attempting to reconnect
 
-    async def send_heartbeat(self, ws):
+    async def handle_text(self, ws, message):
+        raw = message.data
+        if '"pong"' in raw:
+            self.health.on_pong(json_loads(raw).get('req_id'))
+            self.decoder.dropped += 1
+            return
+        # pongs only prove the socket is open, silence is measured by data frames
+        self.health.on_message()
+        if self.on_kline is not None:
+            klines = self.decoder.decode(raw)
+            if klines:
+                self.health.on_confirmed(len(klines))
+            for kline in klines:
+                await self.backfill.emit(kline)
+        else:
+            await self.on_message(ws, message)
+
+    async def _handle_disconnect(self):
+        self.ws = None
+        if self.on_disconnect is not None:
+            try:
+                await self.on_disconnect(self)
+            except Exception as e:
+                print(f"Disconnect handler failed: {e}")
+
+    async def subscribe(self, ws, topics):
+        """
+        Subscribes to topics in chunks accepted by the exchange in one request
+        """
+        for i in range(0, len(topics), self.subscribe_chunk):
+            await ws.send_json({"op": "subscribe", "args": topics[i:i + self.subscribe_chunk]})
+
+    async def send_heartbeat(self, ws, check_interval=5):
+        """
+        Sends pings, updates message rate and closes connection silent for more than stale_after seconds
+        """
+        last_ping = 0
         while True:
             try:
-                await ws.send_json({"req_id": "100001", "op": "ping"})
-                await asyncio.sleep(20)  # Pause between pings
+                now = time.monotonic()
+                if now - last_ping >= self.ping_interval:
+                    req_id = str(next(self._ping_ids))
+                    self.health.on_ping(req_id)
+                    await ws.send_json({"req_id": req_id, "op": "ping"})
+                    last_ping = now
+                self.health.update_rate()
+                silence = self.health.silence()
+                if silence is not None and silence > self.stale_after:
+                    print(f"Websocket silent for {silence:.0f} s, reconnecting")
+                    self.health.forced_reconnects += 1
+                    await ws.close()
+                    break
+                await asyncio.sleep(check_interval)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 await self.on_error(ws, e)
                 break  # Exit the loop to stop sending pings
@@ -46,12 +359,15 @@ class SocketBybit:
     async def on_open(self, ws):
         print(ws, 'Websocket was opened')
 
-        # Запуск асинхронного отправления heartbeat
-        asyncio.create_task(self.send_heartbeat(ws))
+        # Subscribe to topics:
+        await self.subscribe(ws, self.params)
 
-        # Подписка на топики:
-        data = {"op": "subscribe", "args": self.params}
-        await ws.send_json(data)
+    def metrics(self):
+        metrics = self.health.snapshot()
+        metrics.update(self.decoder.stats())
+        metrics['connected'] = self.connected
+        metrics['topics'] = len(self.params)
+        return metrics
 
     async def on_error(self, ws, error):
         print('on_error', ws, error)
@@ -63,16 +379,236 @@ class SocketBybit:
         # await asyncio.sleep(20)
 
 
+class PrivateSocketBybit(SocketBybit):
+    """
+    Authenticated private stream (wallet, position, execution topics)
+
+    Connection is authenticated before subscribing, on_ready is called after every
+    successful (re)subscription, so state can be resynced with REST.
+    """
+
+    def __init__(self, url, api_key, secret_key, topics=('wallet', 'position', 'execution'),
+                 on_message=None, on_ready=None, auth_timeout=10, **kwargs):
+        super().__init__(url, topics, on_message=on_message, **kwargs)
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.on_ready = on_ready
+        self.auth_timeout = auth_timeout
+
+    def auth_args(self):
+        expires = int((time.time() + self.auth_timeout) * 1000)
+        signature = hmac.new(
+            self.secret_key.encode('utf-8'), f'GET/realtime{expires}'.encode('utf-8'), hashlib.sha256
+        ).hexdigest()
+        return [self.api_key, expires, signature]
+
+    async def on_open(self, ws):
+        await ws.send_json({"op": "auth", "args": self.auth_args()})
+        message = await ws.receive(timeout=self.auth_timeout)
+        reply = json_loads(message.data) if message.type == aiohttp.WSMsgType.TEXT else {}
+        # private stream replies with success, trade stream with retCode
+        if not (reply.get('success') or reply.get('retCode') == 0):
+            raise ConnectionError(
+                f"Private websocket auth failed: {reply.get('ret_msg') or reply.get('retMsg') or message.type}"
+            )
+        print(ws, 'Private websocket authorized')
+        await self.subscribe(ws, self.params)
+        if self.on_ready is not None:
+            try:
+                await self.on_ready(self)
+            except Exception as e:
+                print(f"Private websocket ready handler failed: {e}")
+
+
+class OrderNotSent(ConnectionError):
+    """
+    Order request was not sent, it is safe to send it another way
+    """
 
-if __name__ == '__main__':
 
-    async def custom_on_message(ws, msg):
+class TradeSocketBybit(PrivateSocketBybit):
+    """
+    Authenticated trade stream, orders are sent as websocket requests
+
+    Replies are matched to requests by reqId, so several orders can be in flight at once.
+    Requests which were sent but got no reply (timeout, disconnect) fail with
+    ConnectionError / TimeoutError, not OrderNotSent - the order may be already executed.
+    """
+
+    def __init__(self, url, api_key, secret_key, recv_window=5000, reply_timeout=5, **kwargs):
+        super().__init__(url, api_key, secret_key, topics=(), **kwargs)
+        self.recv_window = recv_window
+        self.reply_timeout = reply_timeout
+        self.authorized = False
+        self.pending = {}  # reqId -> future of reply
+        self._req_ids = count(1)
+        self.sent = 0
+
+    @property
+    def ready(self):
+        return self.authorized and self.connected
+
+    async def on_open(self, ws):
+        await super().on_open(ws)
+        self.authorized = True
+
+    async def _handle_disconnect(self):
+        self.authorized = False
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Trade websocket disconnected before order reply"))
+        await super()._handle_disconnect()
+
+    async def on_message(self, ws, msg):
+        reply = json_loads(msg.data)
+        future = self.pending.pop(reply.get('reqId'), None)
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+    async def request(self, op, args):
+        """
+        Sends request and returns reply in REST format {'retCode', 'retMsg', 'result'}
+        """
+        if not self.ready:
+            raise OrderNotSent("Trade websocket is not connected")
+        req_id = f'{next(self._req_ids)}-{int(time.time() * 1000)}'
+        future = asyncio.get_running_loop().create_future()
+        self.pending[req_id] = future
+        request = {
+            "reqId": req_id,
+            "header": {
+                "X-BAPI-TIMESTAMP": str(int(time.time() * 1000)),
+                "X-BAPI-RECV-WINDOW": str(self.recv_window),
+            },
+            "op": op,
+            "args": args,
+        }
+        try:
+            await self.ws.send_json(request)
+        except Exception as e:
+            self.pending.pop(req_id, None)
+            raise OrderNotSent(f"Failed to send {op}: {e}") from e
+        self.sent += 1
         try:
-            data = json.loads(msg.data)
-            if 'data' in data and data.get('data')[0].get('confirm') is True:
-                print("Custom message handler:", data.get('topic'), '\n', data.get('data')[0])
-        except json.JSONDecodeError as e:
-            print(f"Failed to decode JSON in custom handler: {e}")
+            reply = await asyncio.wait_for(future, self.reply_timeout)
+        finally:
+            self.pending.pop(req_id, None)
+        return {'retCode': reply.get('retCode'), 'retMsg': reply.get('retMsg'), 'result': reply.get('data')}
+
+    async def create_order(self, **kwargs):
+        return await self.request('order.create', [{key: str(value) for key, value in kwargs.items()}])
+
+
+class SocketManager:
+    """
+    Runs several websocket connections inside one event loop
+
+    Topics are split into shards of at most topics_per_connection topics,
+    spare_capacity part of each connection is left free to take topics of a dropped connection.
+    """
+
+    def __init__(self, url, topics, on_message=None, topics_per_connection=200, subscribe_chunk=10,
+                 spare_capacity=0.2, on_kline=None):
+        self.url = url
+        self.topics = list(topics)
+        self.on_message = on_message
+        self.on_kline = on_kline
+        self.topics_per_connection = topics_per_connection
+        self.subscribe_chunk = subscribe_chunk
+        self.spare_capacity = spare_capacity
+        self.sockets = []
+        # shared by all connections, so topics moved between connections keep their last start
+        self.backfill = KlineBackfill(on_kline) if on_kline is not None else None
+
+    def shard(self):
+        """
+        Returns list of topic groups, one group per connection
+        """
+        if not self.topics:
+            return [[]]
+        fill_limit = max(1, int(self.topics_per_connection * (1 - self.spare_capacity)))
+        amount = max(1, math.ceil(len(self.topics) / fill_limit))
+        size = math.ceil(len(self.topics) / amount)
+        return [self.topics[i:i + size] for i in range(0, len(self.topics), size)]
+
+    async def run(self):
+        self.sockets = [
+            SocketBybit(self.url, group, on_message=self.on_message, on_kline=self.on_kline,
+                        backfill=self.backfill, subscribe_chunk=self.subscribe_chunk,
+                        on_disconnect=self.rebalance)
+            for group in self.shard()
+        ]
+        print(f"Websocket manager: {len(self.topics)} topics over {len(self.sockets)} connections")
+        await asyncio.gather(self.report_metrics(), *(socket.connect() for socket in self.sockets))
+
+    async def rebalance(self, dropped):
+        """
+        Moves topics of dropped connection to live connections with free capacity
+        Topics left without place stay with dropped connection and are resubscribed on its reconnect
+        """
+        orphaned = list(dropped.params)
+        for socket in self.sockets:
+            if not orphaned:
+                break
+            if socket is dropped or not socket.connected:
+                continue
+            free = self.topics_per_connection - len(socket.params)
+            if free <= 0:
+                continue
+            moved = orphaned[:free]
+            if self.backfill is not None:
+                self.backfill.start(moved)
+            try:
+                await socket.subscribe(socket.ws, moved)
+            except Exception as e:
+                print(f"Failed to move topics to another connection: {e}")
+                continue
+            socket.params.extend(moved)
+            orphaned = orphaned[free:]
+        if len(orphaned) != len(dropped.params):
+            print(f"Websocket manager: moved {len(dropped.params) - len(orphaned)} topics from dropped connection")
+        dropped.params = orphaned
+
+    def metrics(self):
+        """
+        Returns health metrics of every connection
+        """
+        return [socket.metrics() for socket in self.sockets]
+
+    async def report_metrics(self, interval=60):
+        """
+        Prints short feed health summary every interval seconds
+        """
+        while True:
+            await asyncio.sleep(interval)
+            metrics = self.metrics()
+            rtts = [m['rtt_ms'] for m in metrics if m['rtt_ms'] is not None]
+            silences = [m['since_last_message'] for m in metrics if m['since_last_message'] is not None]
+            print(
+                f"WS health: connected {sum(m['connected'] for m in metrics)}/{len(metrics)}, "
+                f"max rtt {max(rtts, default=None)} ms, "
+                f"msg/s {sum(m['messages_per_second'] for m in metrics):.1f}, "
+                f"max silence {max(silences, default=None)} s, "
+                f"decode {self.decode_stats()}"
+            )
+
+    def decode_stats(self):
+        """
+        Returns decoder counters summed over all connections
+        """
+        total = {'dropped': 0, 'decoded': 0, 'errors': 0}
+        for socket in self.sockets:
+            for key, value in socket.decoder.stats().items():
+                total[key] += value
+        return total
+
+
+
+if __name__ == '__main__':
+
+    async def custom_on_kline(kline):
+        print("Custom kline handler:", kline)
 
     url_spot = 'wss://stream.bybit.com/v5/public/spot'
     url_futures = 'wss://stream.bybit.com/v5/public/linear'
@@ -82,5 +618,5 @@ if __name__ == '__main__':
         'kline.1.AXSUSDT',
     ]
 
-    socket = SocketBybit(url_futures, topics, on_message=custom_on_message)
+    socket = SocketBybit(url_futures, topics, on_kline=custom_on_kline)
     asyncio.run(socket.connect())
\ No newline at end of file
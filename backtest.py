@@ -0,0 +1,379 @@
+import asyncio
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from api.api_market import get_lin_perp_info_asc
+from api.sessions import close_sessions
+from kline_cache import KlineCache, download_history
+from levels import DAY_MS
+from signals import breakout_signals
+from utils import interval_to_ms
+
+
+FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+# taker fee of linear contracts and market order slippage, both as rate of price
+TAKER_FEE = 0.00055
+SLIPPAGE = 0.0005
+
+EXIT_TP = 1
+EXIT_SL = 2
+EXIT_END = 3  # position was still open at the end of data, closed by the last close
+EXIT_REASONS = {EXIT_TP: 'tp', EXIT_SL: 'sl', EXIT_END: 'end'}
+
+BacktestResult = namedtuple('BacktestResult', ['trades', 'stats'])
+
+
+class MarketData:
+    """
+    Klines of many symbols aligned on one time grid
+
+    open / high / low / close / volume - arrays (time, symbol), NaN where symbol has no kline,
+    day_open / day_close - daily open and close (day, symbol) used for levels.
+    Levels and SMA are not stored here, backtest computes them block by block.
+    """
+
+    def __init__(self, symbols, interval, times, open, high, low, close, volume,
+                 day_starts, day_open, day_close):
+        self.symbols = list(symbols)
+        self.interval = interval
+        self.times = times
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.day_starts = day_starts
+        self.day_open = day_open
+        self.day_close = day_close
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def shape(self):
+        return self.close.shape
+
+    def day_rows(self):
+        """
+        Returns row of day_starts for each kline
+        """
+        return ((self.times - self.day_starts[0]) // DAY_MS).astype(np.int64)
+
+    @classmethod
+    def from_cache(cls, cache, symbols, interval, dtype=np.float64):
+        """
+        Builds data from KlineCache files (no requests), daily klines are taken from 'D' cache,
+        for symbols without it days are built from klines of interval
+        dtype of kline arrays - np.float32 halves memory of long histories of many symbols
+        """
+        step = interval_to_ms(interval)
+        if step is None or DAY_MS % step:
+            raise ValueError(f"Backtest needs interval which divides a day, got {interval}")
+        klines = {symbol: cache.load(symbol, interval) for symbol in symbols}
+        symbols = [symbol for symbol in symbols if len(klines[symbol])]
+        if not symbols:
+            raise ValueError('No cached klines for backtest')
+
+        first = min(int(klines[symbol]['start'][0]) for symbol in symbols)
+        last = max(int(klines[symbol]['start'][-1]) for symbol in symbols)
+        times = np.arange(first, last + step, step, dtype=np.int64)
+        arrays = {field: np.full((len(times), len(symbols)), np.nan, dtype=dtype) for field in FIELDS}
+        for column, symbol in enumerate(symbols):
+            data = klines[symbol]
+            rows = (data['start'] - first) // step
+            for field in FIELDS:
+                arrays[field][rows, column] = data[field]
+
+        day_first = first // DAY_MS * DAY_MS
+        day_starts = np.arange(day_first, last // DAY_MS * DAY_MS + DAY_MS, DAY_MS, dtype=np.int64)
+        day_open = np.full((len(day_starts), len(symbols)), np.nan)
+        day_close = np.full((len(day_starts), len(symbols)), np.nan)
+
+        # дни из свечей интервала: открытие первой свечи дня, закрытие последней
+        day_index = (times - day_first) // DAY_MS
+        built_open = pd.DataFrame(arrays['open']).groupby(day_index).first()
+        built_close = pd.DataFrame(arrays['close']).groupby(day_index).last()
+        day_open[built_open.index] = built_open.to_numpy()
+        day_close[built_close.index] = built_close.to_numpy()
+
+        for column, symbol in enumerate(symbols):
+            days = cache.load(symbol, 'D')
+            days = days[(days['start'] >= day_first) & (days['start'] <= day_starts[-1])]
+            if len(days):
+                rows = (days['start'] - day_first) // DAY_MS
+                day_open[:, column] = np.nan
+                day_close[:, column] = np.nan
+                day_open[rows, column] = days['open']
+                day_close[rows, column] = days['close']
+
+        return cls(symbols, interval, times, *(arrays[field] for field in FIELDS),
+                   day_starts, day_open, day_close)
+
+
+def daily_levels(data, window):
+    """
+    Returns resistance and support (day, symbol), row of day as in data.day_starts
+    Levels of a day - max / min of open and close over `window` previous closed days,
+    same as find_resistance_support
+    """
+    day_high = pd.DataFrame(np.fmax(data.day_open, data.day_close))
+    day_low = pd.DataFrame(np.fmin(data.day_open, data.day_close))
+    # уровни дня считаются по закрытым дням до него
+    resistance = day_high.rolling(window, min_periods=1).max().shift(1).to_numpy()
+    support = day_low.rolling(window, min_periods=1).min().shift(1).to_numpy()
+    return resistance, support
+
+
+def volume_sma(volume, period):
+    """
+    Returns SMA of volume of `period` klines before each kline (as RollingSMA.prev_sma)
+    Each value is summed over its own window, so SMA of a block equals the same rows of the whole array
+    """
+    sma = np.full(volume.shape, np.nan)
+    if len(volume) <= period:
+        return sma
+    total = volume[:len(volume) - period].astype(np.float64)
+    for shift in range(1, period):
+        total += volume[shift:len(volume) - period + shift]
+    sma[period:] = total / period
+    return sma
+
+
+def find_signals(data, levels, sma_period, multiplicator, sma=None, block_cells=4_000_000):
+    """
+    Returns (rows, columns, is_long) of breakout signals of all klines
+
+    Klines are checked in blocks of about block_cells values, levels of each kline are taken
+    from its day row and SMA is computed for the block only, so no extra (time, symbol) arrays
+    are kept. sma - precomputed volume_sma of the whole data, if it is shared between runs.
+    """
+    resistance, support = levels
+    day_rows = data.day_rows()
+    block = max(1, block_cells // max(1, data.shape[1]))
+    found = []
+    for begin in range(0, len(data), block):
+        end = min(begin + block, len(data))
+        if sma is None:
+            # окно SMA захватывает sma_period свечей до блока
+            first = max(0, begin - sma_period)
+            prev_sma = volume_sma(data.volume[first:end], sma_period)[begin - first:]
+        else:
+            prev_sma = sma[begin:end]
+        days = day_rows[begin:end]
+        long_idx, short_idx = breakout_signals(
+            data.open[begin:end], data.close[begin:end], data.volume[begin:end], prev_sma,
+            resistance[days], support[days], multiplicator
+        )
+        for indices, is_long in ((long_idx, True), (short_idx, False)):
+            rows, columns = np.unravel_index(indices, (end - begin, data.shape[1]))
+            found.append((rows + begin, columns, np.full(len(rows), is_long)))
+    if not found:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+    rows, columns, is_long = (np.concatenate(parts) for parts in zip(*found))
+    return rows, columns, is_long
+
+
+def find_exits(data, rows, columns, is_long, take_profit, stop_loss, horizon=256):
+    """
+    Finds first kline after entry which touches TP or SL, for all trades at once
+    Klines are checked in blocks of `horizon` for all open trades, block grows for trades left open.
+    If TP and SL are touched by the same kline SL is taken.
+    Returns (exit row, exit reason, exit price before slippage)
+    """
+    size = len(data)
+    amount = len(rows)
+    exit_rows = np.full(amount, size - 1, dtype=np.int64)
+    reasons = np.full(amount, EXIT_END, dtype=np.int8)
+    active = np.arange(amount)
+    offset = 1
+    while active.size:
+        steps = np.arange(offset, offset + horizon)
+        block_rows = rows[active, None] + steps[None, :]
+        valid = block_rows < size
+        block_rows = np.minimum(block_rows, size - 1)
+        block_columns = columns[active, None]
+        high = data.high[block_rows, block_columns]
+        low = data.low[block_rows, block_columns]
+        long = is_long[active, None]
+        tp = take_profit[active, None]
+        sl = stop_loss[active, None]
+        tp_hit = np.where(long, high >= tp, low <= tp) & valid
+        sl_hit = np.where(long, low <= sl, high >= sl) & valid
+        hit = tp_hit | sl_hit
+
+        found = hit.any(axis=1)
+        first = hit.argmax(axis=1)
+        resolved = active[found]
+        exit_rows[resolved] = block_rows[found, first[found]]
+        reasons[resolved] = np.where(sl_hit[found, first[found]], EXIT_SL, EXIT_TP)
+
+        # сделки, дошедшие до конца данных, остаются с EXIT_END
+        ended = ~found & (rows[active] + offset + horizon > size - 1)
+        active = active[~found & ~ended]
+        offset += horizon
+        horizon *= 2
+
+    # позиция, открытая до конца данных, закрывается последней ценой пары
+    valid_close = ~np.isnan(data.close)
+    last_valid = size - 1 - valid_close[::-1].argmax(axis=0)
+    ended = reasons == EXIT_END
+    exit_rows[ended] = np.maximum(rows[ended], last_valid[columns[ended]])
+
+    exit_open = data.open[exit_rows, columns]
+    prices = data.close[exit_rows, columns].copy()
+    tp_mask = reasons == EXIT_TP
+    sl_mask = reasons == EXIT_SL
+    # если свеча открылась за уровнем, исполнение по цене открытия
+    prices[tp_mask] = np.where(is_long[tp_mask], np.fmax(take_profit[tp_mask], exit_open[tp_mask]),
+                               np.fmin(take_profit[tp_mask], exit_open[tp_mask]))
+    prices[sl_mask] = np.where(is_long[sl_mask], np.fmin(stop_loss[sl_mask], exit_open[sl_mask]),
+                               np.fmax(stop_loss[sl_mask], exit_open[sl_mask]))
+    return exit_rows, reasons, prices
+
+
+def one_position_per_symbol(columns, rows, exit_rows):
+    """
+    Returns mask of trades opened while symbol has no open position (as on one-way exchange account)
+    """
+    keep = np.zeros(len(rows), dtype=bool)
+    busy_until = {}
+    for i in np.lexsort((rows, columns)):
+        column = columns[i]
+        if rows[i] > busy_until.get(column, -1):
+            keep[i] = True
+            busy_until[column] = exit_rows[i]
+    return keep
+
+
+def backtest(data, window, sma_period, multiplicator, tp_rate, sl_rate,
+             fee_rate=TAKER_FEE, slippage=SLIPPAGE, levels=None, sma=None):
+    """
+    Replays data through the strategy of perform_strategy
+
+    - signal: breakout_signals on each kline with daily levels and volume SMA * multiplicator
+    - entry: market order at kline close, TP / SL from close by tp_rate / sl_rate
+    - fills: slippage against the trade on entry and exit, fee_rate on entry and exit notional
+    levels - (resistance, support) from daily_levels, sma - from volume_sma, pass to reuse between runs
+    Returns BacktestResult(trades dataframe, stats dict)
+    """
+    levels = levels if levels is not None else daily_levels(data, window)
+    rows, columns, is_long = find_signals(data, levels, sma_period, multiplicator, sma=sma)
+    # на последней свече данных открывать нечего - дальше нет цен
+    inside = rows < len(data) - 1
+    rows, columns, is_long = rows[inside], columns[inside], is_long[inside]
+
+    reference = data.close[rows, columns]
+    direction = np.where(is_long, 1.0, -1.0)
+    take_profit = reference * (1 + direction * tp_rate)
+    stop_loss = reference * (1 - direction * sl_rate)
+    entry = reference * (1 + direction * slippage)
+
+    exit_rows, reasons, exit_prices = find_exits(data, rows, columns, is_long, take_profit, stop_loss)
+    keep = one_position_per_symbol(columns, rows, exit_rows)
+    rows, columns, is_long, direction = rows[keep], columns[keep], is_long[keep], direction[keep]
+    entry, take_profit, stop_loss = entry[keep], take_profit[keep], stop_loss[keep]
+    exit_rows, reasons = exit_rows[keep], reasons[keep]
+    exit_prices = exit_prices[keep] * (1 - direction * slippage)
+
+    gross = direction * (exit_prices / entry - 1)
+    fees = fee_rate * (1 + exit_prices / entry)
+    trades = pd.DataFrame({
+        'symbol': np.array(data.symbols, dtype=object)[columns],
+        'side': np.where(is_long, 'Buy', 'Sell'),
+        'entry_time': pd.to_datetime(data.times[rows], unit='ms'),
+        'exit_time': pd.to_datetime(data.times[exit_rows], unit='ms'),
+        'entry_price': entry,
+        'exit_price': exit_prices,
+        'take_profit': take_profit,
+        'stop_loss': stop_loss,
+        'exit_reason': pd.Categorical.from_codes(reasons - 1, list(EXIT_REASONS.values())),
+        'bars_held': exit_rows - rows,
+        'gross_return': gross,
+        'fees': fees,
+        'net_return': gross - fees,
+    })
+    trades = trades.sort_values(['entry_time', 'symbol'], ignore_index=True)
+    return BacktestResult(trades, trade_stats(trades))
+
+
+def trade_stats(trades):
+    """
+    Returns aggregate statistics of trades, returns are summed per trade of equal stake
+    """
+    if trades.empty:
+        return {'trades': 0}
+    net = trades['net_return'].to_numpy()
+    # кривая доходности по времени закрытия сделок
+    equity = np.cumsum(net[np.argsort(trades['exit_time'].to_numpy(), kind='stable')])
+    drawdown = np.maximum.accumulate(np.concatenate([[0.0], equity]))[1:] - equity
+    wins = net[net > 0]
+    losses = net[net <= 0]
+    return {
+        'trades': len(net),
+        'long': int((trades['side'] == 'Buy').sum()),
+        'short': int((trades['side'] == 'Sell').sum()),
+        'win_rate': len(wins) / len(net),
+        'total_return': float(net.sum()),
+        'mean_return': float(net.mean()),
+        'std_return': float(net.std()),
+        'profit_factor': float(wins.sum() / -losses.sum()) if losses.sum() < 0 else np.inf,
+        'max_drawdown': float(drawdown.max()),
+        'fees': float(trades['fees'].sum()),
+        'mean_bars_held': float(trades['bars_held'].mean()),
+        'exits': trades['exit_reason'].value_counts().to_dict(),
+    }
+
+
+def history_cache():
+    """
+    Returns offline KlineCache of backtests, files are not cut to the last klines
+    """
+    return KlineCache(os.getenv('history_cache_path', 'klines_history'), max_rows=None)
+
+
+def cached_symbols(cache, interval):
+    interval_path = os.path.join(cache.path, str(interval))
+    if not os.path.isdir(interval_path):
+        return []
+    return sorted(name[:-4] for name in os.listdir(interval_path) if name.endswith('.npy'))
+
+
+async def load_history(cache, interval, days):
+    """
+    Downloads `days` days of klines of interval and daily klines of all linear USDT pairs into cache
+    """
+    try:
+        _, symbols, _ = await get_lin_perp_info_asc()
+        start = (int(time.time() * 1000) // DAY_MS - days) * DAY_MS
+        return await download_history(cache, symbols, [interval, 'D'], start)
+    finally:
+        await close_sessions()
+
+
+def main():
+    # данные берутся из офлайн кеша истории; если задан history_days - недостающая история догружается с биржи
+    cache = history_cache()
+    interval = os.getenv('backtest_interval', '5')
+    days = int(os.getenv('history_days', 0))
+    if days:
+        asyncio.run(load_history(cache, interval, days))
+    symbols = cached_symbols(cache, interval)
+
+    started = time.time()
+    data = MarketData.from_cache(cache, symbols, interval)
+    print(f"Loaded {data.shape[1]} symbols x {data.shape[0]} klines in {time.time() - started:.2f} s")
+
+    started = time.time()
+    result = backtest(data, window=30, sma_period=20, multiplicator=3, tp_rate=0.05, sl_rate=0.03)
+    print(result.trades)
+    print(result.stats)
+    print(f"Backtest done in {time.time() - started:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+load_dotenv()
+
+DATABASE_URL = str(os.getenv('database_url'))
+
+POOL_SIZE = int(os.getenv('db_pool_size', 5))
+MAX_OVERFLOW = int(os.getenv('db_max_overflow', 5))
+STATEMENT_CACHE_SIZE = int(os.getenv('db_statement_cache_size', 256))
+
+_engine = None
+_async_session = None
+_engine_pid = None
+
+
+def get_engine():
+    """
+    Returns process-wide async engine (one connection pool per process)
+
+    Asyncpg prepares each statement once per connection and keeps it
+    in the statement cache, so repeated upserts skip parsing and planning.
+    Engine is recreated in a child process, pooled connections can not be shared after fork.
+    """
+    global _engine, _async_session, _engine_pid
+    if _engine is None or _engine_pid != os.getpid():
+        _engine = create_async_engine(
+            DATABASE_URL,
+            echo=False,
+            pool_size=POOL_SIZE,
+            max_overflow=MAX_OVERFLOW,
+            pool_pre_ping=True,
+            connect_args={'prepared_statement_cache_size': STATEMENT_CACHE_SIZE},
+        )
+        _async_session = sessionmaker(_engine, class_=AsyncSession)
+        _engine_pid = os.getpid()
+    return _engine
+
+
+def get_sessionmaker():
+    """
+    Returns session factory bound to the process-wide engine
+    """
+    get_engine()
+    return _async_session
+
+
+async def dispose_engine():
+    """
+    Closes all pooled connections of the process-wide engine
+    """
+    global _engine, _async_session, _engine_pid
+    if _engine is not None:
+        await _engine.dispose()
+    _engine = None
+    _async_session = None
+    _engine_pid = None
@@ -1,15 +1,10 @@
-import os
 import asyncio
 import pandas as pd
-from dotenv import load_dotenv
 from sqlalchemy import Column, BigInteger, String, Float, DateTime, func, text, delete, select, inspect
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.orm import declarative_base
 from sqlalchemy.dialects.postgresql import insert
 
-load_dotenv()
-
-DATABASE_URL = str(os.getenv('database_url'))
+from db.engine import get_engine, get_sessionmaker
 
 Base = declarative_base()
 
@@ -27,14 +22,26 @@ class FutureKlines(Base):
     #updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
 
+KLINE_FIELDS = ('start', 'symbol', 'open', 'close', 'high', 'low', 'volume')
+
+# one statement shape for single and bulk upserts - prepared once per pooled connection
+UPSERT_KLINE = insert(FutureKlines)
+UPSERT_KLINE = UPSERT_KLINE.on_conflict_do_update(
+    index_elements=['symbol'],
+    set_={field: UPSERT_KLINE.excluded[field] for field in KLINE_FIELDS if field != 'symbol'}
+)
+
+
 class FutureKlinesOperations:
-    def __init__(self):
-        self.engine = create_async_engine(DATABASE_URL, echo=False)
-        self.async_session = sessionmaker(self.engine, class_=AsyncSession)
+    # engine and pool are shared by all instances in the process,
+    # resolved on access so an instance created before fork uses the child's own pool
+    @property
+    def engine(self):
+        return get_engine()
 
-        # Создание таблицы, если она не существует
-        # if not self.table_exists(FutureKlines.__tablename__):
-        #     self.create_table()
+    @property
+    def async_session(self):
+        return get_sessionmaker()
 
     async def table_exists(self, table_name):
         async with self.engine.connect() as conn:
@@ -53,29 +60,20 @@ class FutureKlinesOperations:
             print(f"Table '{FutureKlines.__tablename__}' already exists, skipping creation.")
 
     async def upsert_kline(self, start, symbol, open, close, high, low, volume):
+        await self.upsert_klines([(start, symbol, open, close, high, low, volume)])
+
+    async def upsert_klines(self, klines, batch_size=1000):
+        """
+        Upserts klines in batches, each batch is sent as one executemany call
+        klines - iterable of tuples (start, symbol, open, close, high, low, volume)
+        """
+        rows = [dict(zip(KLINE_FIELDS, kline)) for kline in klines]
+        if not rows:
+            return
         async with self.async_session() as session:
             async with session.begin():
-                stmt = insert(FutureKlines).values(
-                    start=start,
-                    symbol=symbol,
-                    open=open,
-                    close=close,
-                    high=high,
-                    low=low,
-                    volume=volume
-                ).on_conflict_do_update(
-                    index_elements=['symbol'],
-                    set_={
-                        'start': start,
-                        'open': open,
-                        'close': close,
-                        'high': high,
-                        'low': low,
-                        'volume': volume
-                    }
-                )
-                await session.execute(stmt)
-                await session.commit()
+                for i in range(0, len(rows), batch_size):
+                    await session.execute(UPSERT_KLINE, rows[i:i + batch_size])
 
     async def select_klines(self):
         async with self.async_session() as session:
@@ -131,6 +129,10 @@ if __name__ == '__main__':
         await db_futures.create_table()
 
         await db_futures.upsert_kline(1625438400, 'BTCU', 35000.0, 35500.0, 36000.0, 34500.0, 1000.0)
+        await db_futures.upsert_klines([
+            (1625438400, 'ETHU', 2000.0, 2050.0, 2100.0, 1950.0, 500.0),
+            (1625438400, 'SOLU', 30.0, 31.0, 32.0, 29.0, 800.0),
+        ])
 
         df_klines = await db_futures.select_klines()
         print(df_klines)
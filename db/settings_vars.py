@@ -1,16 +1,12 @@
-import os
 import asyncio
 import pandas as pd
-from dotenv import load_dotenv
 from sqlalchemy import Column, BigInteger, String, Float, DateTime, func, text, delete, select, inspect
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.orm import declarative_base
 from sqlalchemy.dialects.postgresql import insert
 import json
 from sqlalchemy.exc import SQLAlchemyError
 
-load_dotenv()
-DATABASE_URL = str(os.getenv('database_url'))
+from db.engine import get_engine, get_sessionmaker
 
 
 Base = declarative_base()
@@ -23,11 +19,24 @@ class SettingsVars(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
+# one statement shape for single and bulk upserts - prepared once per pooled connection
+UPSERT_SETTING = insert(SettingsVars)
+UPSERT_SETTING = UPSERT_SETTING.on_conflict_do_update(
+    index_elements=['name'],
+    set_={'value': UPSERT_SETTING.excluded.value}
+)
+
+
 class SettingsVarsOperations:
-    def __init__(self):
-        self.engine = create_async_engine(DATABASE_URL, echo=False)
-        self.async_session = sessionmaker(self.engine, class_=AsyncSession)
+    # engine and pool are shared by all instances in the process,
+    # resolved on access so an instance created before fork uses the child's own pool
+    @property
+    def engine(self):
+        return get_engine()
 
+    @property
+    def async_session(self):
+        return get_sessionmaker()
 
     async def table_exists(self, table_name):
         async with self.engine.connect() as conn:
@@ -48,34 +57,15 @@ class SettingsVarsOperations:
     async def upsert_settings(self, name, value):
         async with self.async_session() as session:
             async with session.begin():
-                stmt = insert(SettingsVars).values(
-                    name=name,
-                    value=value
-                ).on_conflict_do_update(
-                    index_elements=['name'],
-                    set_={
-                        'value': value,
-                    }
-                )
-                await session.execute(stmt)
-                await session.commit()
-
-    async def upsert_settings_bulk(self, settings_dict):
+                await session.execute(UPSERT_SETTING, [{'name': name, 'value': value}])
+
+    async def upsert_settings_bulk(self, settings_dict, batch_size=1000):
+        rows = [{'name': name, 'value': value} for name, value in settings_dict.items()]
         async with self.async_session() as session:
             async with session.begin():
                 try:
-                    for name, value in settings_dict.items():
-                        stmt = insert(SettingsVars).values(
-                            name=name,
-                            value=value
-                        ).on_conflict_do_update(
-                            index_elements=['name'],
-                            set_={
-                                'value': value,
-                            }
-                        )
-                        await session.execute(stmt)
-                    await session.commit()
+                    for i in range(0, len(rows), batch_size):
+                        await session.execute(UPSERT_SETTING, rows[i:i + batch_size])
 
                     return True
 
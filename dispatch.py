@@ -0,0 +1,92 @@
+import asyncio
+from collections import namedtuple
+
+
+# signal of one candle, score - strength used for ranking (volume / SMA)
+Signal = namedtuple('Signal', ['symbol', 'side', 'score'])
+
+
+class OrderDispatcher:
+    """
+    Places orders of all signals of one candle at once
+
+    Signals are ranked by score, available balance is split equally between
+    the best signals whose share still covers the minimal order of the symbol,
+    signals which can not get enough budget are dropped before any request.
+    Orders are sent concurrently, at most max_concurrency at a time.
+    """
+
+    def __init__(self, client, max_concurrency=5, max_orders=None):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_orders = max_orders
+        self.dropped = 0
+
+    async def allocate(self, signals, available):
+        """
+        Returns list of (signal, budget, price) for best ranked signals which fit into available balance
+        """
+        client = self.client
+        ranked = sorted(signals, key=lambda signal: signal.score, reverse=True)
+        if self.max_orders is not None:
+            ranked = ranked[:self.max_orders]
+        if not client.instruments:
+            await client.instruments.refresh()
+        ranked = [signal for signal in ranked if signal.symbol in client.instruments]
+        prices = await asyncio.gather(
+            *(client.get_pair_price_asc(signal.symbol) for signal in ranked), return_exceptions=True
+        )
+
+        chosen = []
+        max_cost = 0
+        for signal, price in zip(ranked, prices):
+            if price is None or isinstance(price, Exception):
+                continue
+            instrument = client.instruments.get(signal.symbol)
+            # стоимость минимального ордера пары
+            cost = float(price) * max(instrument.minOrderQty, instrument.base_coin_prec)
+            # сигнал берется, если равная доля баланса покрывает минимальный ордер каждой выбранной пары
+            if available / (len(chosen) + 1) >= max(max_cost, cost):
+                chosen.append((signal, price))
+                max_cost = max(max_cost, cost)
+        self.dropped += len(signals) - len(chosen)
+        if not chosen:
+            return []
+        budget = available / len(chosen)
+        return [(signal, budget, price) for signal, price in chosen]
+
+    async def _submit(self, fields):
+        async with self.semaphore:
+            try:
+                return await self.client.submit_order(fields)
+            except Exception as e:
+                print(f"Failed to place {fields.side} {fields.symbol}: {e}")
+                return None
+
+    async def dispatch(self, signals):
+        """
+        Places orders for signals, returns list of (signal, exchange reply or None)
+        """
+        if not signals:
+            return []
+        client = self.client
+        if client.start_budget is None:
+            await client.initialize_start_budget()
+        total_balance, available = await client.get_balance()
+        if total_balance <= client.risk_limit * client.start_budget:
+            print('Budget drop to minimum, stop trading!!!')
+            return []
+
+        allocation = await self.allocate(signals, available)
+        if len(allocation) < len(signals):
+            skipped = {signal.symbol for signal in signals} - {signal.symbol for signal, _, _ in allocation}
+            print(f"Not enough budget for all signals, skipped: {', '.join(sorted(skipped))}")
+
+        # объем и цены TP / SL всей пачки считаются сразу, в ордера уходят готовые строки
+        orders = client.sizing.size_batch(
+            [(signal.symbol, signal.side, budget, price) for signal, budget, price in allocation],
+            client.tp_rate, client.sl_rate
+        )
+        placed = [(signal, fields) for (signal, _, _), fields in zip(allocation, orders) if fields is not None]
+        results = await asyncio.gather(*(self._submit(fields) for _, fields in placed))
+        return [(signal, result) for (signal, _), result in zip(placed, results)]
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class RollingSMA:
+    """
+    Rolling mean of the last `period` values for each symbol
+
+    Each symbol keeps a fixed-size ring buffer and running sum, so update is O(1).
+    prev_sma is the mean of the window before the latest value (latest value not included),
+    NaN until `period` values are collected.
+    """
+
+    def __init__(self, symbols, period):
+        self.period = period
+        self.index = {symbol: row for row, symbol in enumerate(symbols)}
+        size = len(self.index)
+        self.buffer = np.zeros((size, period))
+        self.sums = np.zeros(size)
+        self.counts = np.zeros(size, dtype=np.int64)
+        self.pos = np.zeros(size, dtype=np.int64)
+        self.last_start = np.full(size, -1, dtype=np.int64)
+        self.prev_sma = np.full(size, np.nan)
+
+    def update(self, symbol, start, value):
+        """
+        Adds value of the kline with given start
+        Returns False if symbol is unknown or kline is not newer than the last one
+        """
+        row = self.index.get(symbol)
+        if row is None or start <= self.last_start[row]:
+            return False
+        self.last_start[row] = start
+
+        period = self.period
+        count = self.counts[row]
+        pos = self.pos[row]
+        if count >= period:
+            self.prev_sma[row] = self.sums[row] / period
+            self.sums[row] -= self.buffer[row, pos]
+        else:
+            self.counts[row] = count + 1
+
+        self.buffer[row, pos] = value
+        self.sums[row] += value
+        pos += 1
+        if pos == period:
+            pos = 0
+            # re-sum once per full cycle to drop accumulated float error
+            self.sums[row] = self.buffer[row].sum()
+        self.pos[row] = pos
+        return True
+
+    def sma(self, symbol):
+        """
+        Returns mean of the window before the latest value
+        """
+        row = self.index.get(symbol)
+        if row is None:
+            return np.nan
+        return self.prev_sma[row]
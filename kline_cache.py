@@ -0,0 +1,178 @@
+import asyncio
+import os
+import time
+
+import numpy as np
+
+from api.api_market import MAIN_URL, MARKET_URL, get_klines_asc
+from utils import interval_to_ms
+
+
+CACHE_DTYPE = np.dtype([
+    ('start', '<i8'),
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<f8'),
+])
+
+# max klines returned by exchange in one request
+REQUEST_LIMIT = 1000
+
+
+def klines_to_array(klines_list):
+    """
+    Converts exchange kline list (newest first, values as strings) to ascending CACHE_DTYPE array
+    """
+    data = np.array(
+        [(int(k[0]), float(k[1]), float(k[2]), float(k[3]), float(k[4]), float(k[5])) for k in klines_list],
+        dtype=CACHE_DTYPE
+    )
+    return np.sort(data, order='start')
+
+
+class KlineCache:
+    """
+    On-disk cache of closed klines, one .npy file per (symbol, interval)
+
+    Files are loaded memory mapped, on request only klines closed after
+    the last cached one are fetched from the exchange and appended.
+    Files are cut to the last max_rows klines on save, max_rows=None keeps all
+    (offline caches filled with download for backtests).
+    """
+
+    def __init__(self, path='klines_cache', max_rows=100_000):
+        self.path = path
+        self.max_rows = max_rows
+
+    def file(self, symbol, interval):
+        return os.path.join(self.path, str(interval), f'{symbol}.npy')
+
+    def load(self, symbol, interval):
+        """
+        Returns cached klines of symbol (ascending by start), empty array if nothing is cached
+        """
+        file = self.file(symbol, interval)
+        if not os.path.exists(file):
+            return np.empty(0, dtype=CACHE_DTYPE)
+        try:
+            return np.load(file, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            print(f"Broken cache file {file}: {e}")
+            return np.empty(0, dtype=CACHE_DTYPE)
+
+    def save(self, symbol, interval, data):
+        file = self.file(symbol, interval)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp_file = f'{file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, np.ascontiguousarray(data[-self.max_rows:] if self.max_rows else data))
+        os.replace(tmp_file, file)
+
+    async def fetch(self, symbol, interval, limit, start=None, end=None, base_url=MAIN_URL):
+        response = await get_klines_asc(symbol, interval, limit, start=start, end=end, base_url=base_url)
+        if response.get('retMsg') != 'OK':
+            raise ValueError(f"Failed to get klines for {symbol}: {response.get('retMsg')}")
+        return klines_to_array(response.get('result').get('list'))
+
+    async def get(self, symbol, interval, limit):
+        """
+        Returns last `limit` closed klines of symbol (ascending by start)
+        Fetches only klines missing after the cached tail
+        """
+        step = interval_to_ms(interval)
+        now_ms = time.time() * 1000
+        if step is None:
+            # интервал без фиксированной длины (месяц) не кешируется
+            data = await self.fetch(symbol, interval, limit + 1)
+            return data[:-1][-limit:]
+
+        cached = self.load(symbol, interval)
+        if len(cached):
+            last = int(cached['start'][-1])
+            # количество свечей после последней в кеше, включая текущую незакрытую
+            missing = int((now_ms - last) // step)
+        else:
+            last = None
+            missing = None
+
+        if missing is not None and missing < REQUEST_LIMIT and len(cached) + missing - 1 >= limit:
+            if missing <= 1:
+                return np.array(cached[-limit:])
+            fetched = await self.fetch(symbol, interval, missing + 1, start=last + step)
+            fetched = fetched[(fetched['start'] > last) & (fetched['start'] + step <= now_ms)]
+            data = np.concatenate([cached, fetched])
+        else:
+            # кеша нет, в нем мало свечей или разрыв слишком большой - берем последние свечи
+            fetched = await self.fetch(symbol, interval, min(limit + 1, REQUEST_LIMIT))
+            fetched = fetched[fetched['start'] + step <= now_ms]
+            if last is not None and len(fetched) and fetched['start'][0] <= last + step:
+                data = np.concatenate([cached[cached['start'] < fetched['start'][0]], fetched])
+            else:
+                data = fetched
+
+        if len(fetched):
+            self.save(symbol, interval, data)
+        return np.array(data[-limit:])
+
+    async def download(self, symbol, interval, start, end=None, base_url=MARKET_URL):
+        """
+        Adds closed klines of symbol from start to end (ms, default now) to cache
+        Ranges before and after the cached klines are fetched page by page from their end back,
+        REQUEST_LIMIT klines per request. Returns amount of cached klines.
+        """
+        step = interval_to_ms(interval)
+        if step is None:
+            raise ValueError(f"Interval {interval} has no fixed length, it can not be downloaded")
+        now_ms = int(time.time() * 1000)
+        end = now_ms if end is None else min(int(end), now_ms)
+        cached = self.load(symbol, interval)
+        if len(cached):
+            first, last = int(cached['start'][0]), int(cached['start'][-1])
+            ranges = [(start, first - step), (last + step, end)]
+        else:
+            ranges = [(start, end)]
+
+        pages = []
+        for range_start, range_end in ranges:
+            page_end = range_end
+            while page_end >= range_start:
+                page = await self.fetch(symbol, interval, REQUEST_LIMIT, start=range_start, end=page_end,
+                                        base_url=base_url)
+                if not len(page):
+                    break
+                pages.append(page)
+                page_end = int(page['start'][0]) - step
+                if len(page) < REQUEST_LIMIT:
+                    break
+        if not pages:
+            return len(cached)
+
+        data = np.concatenate([cached] + pages)
+        # незакрытая свеча в кеш не пишется, страницы могут пересекаться на границах
+        data = data[data['start'] + step <= now_ms]
+        _, unique = np.unique(data['start'], return_index=True)
+        data = data[unique]
+        self.save(symbol, interval, data)
+        return len(data)
+
+
+async def download_history(cache, symbols, intervals, start, end=None):
+    """
+    Downloads klines of all symbols and intervals from start to end (ms) into cache
+    Returns list of (symbol, interval) which failed
+    """
+    targets = [(symbol, interval) for interval in intervals for symbol in symbols]
+    started = time.time()
+    results = await asyncio.gather(
+        *(cache.download(symbol, interval, start, end) for symbol, interval in targets), return_exceptions=True
+    )
+    failed = []
+    for target, result in zip(targets, results):
+        if isinstance(result, Exception):
+            print(f"Failed to download {target[1]} klines of {target[0]}: {result}")
+            failed.append(target)
+    print(f"Downloaded klines of {len(symbols)} symbols x {len(intervals)} intervals "
+          f"in {time.time() - started:.1f} s, failed {len(failed)}")
+    return failed
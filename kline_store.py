@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class KlineStore:
+    """
+    Last `window` klines of each symbol in preallocated ring arrays
+
+    Arrays have shape (symbols, window), float64, row of symbol is fixed in self.index.
+    Append is O(1), kline is skipped if its start is not newer than the last stored one.
+    """
+
+    FIELDS = ('start', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, symbols, window):
+        self.symbols = list(symbols)
+        self.index = {symbol: row for row, symbol in enumerate(self.symbols)}
+        self.window = window
+        size = len(self.symbols)
+        self.start = np.full((size, window), np.nan)
+        self.open = np.full((size, window), np.nan)
+        self.high = np.full((size, window), np.nan)
+        self.low = np.full((size, window), np.nan)
+        self.close = np.full((size, window), np.nan)
+        self.volume = np.full((size, window), np.nan)
+        self.pos = np.zeros(size, dtype=np.int64)  # next slot to write
+        self.counts = np.zeros(size, dtype=np.int64)
+        self.last_start = np.full(size, -1, dtype=np.int64)
+
+    def append(self, start, symbol, open, close, high, low, volume):
+        """
+        Stores kline (arguments in transport record order)
+        Returns row of symbol or None if symbol is unknown or kline is a duplicate / older one
+        """
+        row = self.index.get(symbol)
+        if row is None or start <= self.last_start[row]:
+            return None
+        pos = self.pos[row]
+        self.start[row, pos] = start
+        self.open[row, pos] = open
+        self.high[row, pos] = high
+        self.low[row, pos] = low
+        self.close[row, pos] = close
+        self.volume[row, pos] = volume
+        self.pos[row] = (pos + 1) % self.window
+        if self.counts[row] < self.window:
+            self.counts[row] += 1
+        self.last_start[row] = start
+        return row
+
+    def last(self, rows):
+        """
+        Returns dict of arrays with the latest kline of each given row
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        slots = (self.pos[rows] - 1) % self.window
+        return {field: getattr(self, field)[rows, slots] for field in self.FIELDS}
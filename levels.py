@@ -0,0 +1,275 @@
+import asyncio
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+from signals import levels_to_arrays
+from utils import interval_to_ms
+
+
+DAY_MS = 86_400_000
+
+# levels snapshot used by the strategy, replaced as a whole on refresh
+# partial - levels of failed pairs were not updated for `day`
+LevelsTable = namedtuple('LevelsTable', ['day', 'levels', 'resistance', 'support', 'partial', 'failed'])
+
+
+class MonotonicWindow:
+    """
+    Max and min of values keyed by time within the last `span` (e.g. days within window * DAY_MS)
+
+    Monotonic deques keep only candidates for max / min, push of a newer key is amortized O(1).
+    Key older than the newest one is inserted by rebuilding the deques from the kept entries.
+    """
+
+    def __init__(self, span):
+        self.span = span
+        self.entries = deque()  # (key, high, low), keys increasing
+        self.max_queue = deque()  # (key, value), values decreasing
+        self.min_queue = deque()  # (key, value), values increasing
+
+    def push(self, key, high, low):
+        """
+        Adds value of key, returns False if key is already added or is out of the window
+        """
+        if self.entries and key <= self.entries[-1][0]:
+            return self._insert(key, high, low)
+        self.entries.append((key, high, low))
+        self._append(key, high, low)
+        oldest = key - self.span
+        while self.entries[0][0] <= oldest:
+            self.entries.popleft()
+        while self.max_queue[0][0] <= oldest:
+            self.max_queue.popleft()
+        while self.min_queue[0][0] <= oldest:
+            self.min_queue.popleft()
+        return True
+
+    def _append(self, key, high, low):
+        while self.max_queue and self.max_queue[-1][1] <= high:
+            self.max_queue.pop()
+        self.max_queue.append((key, high))
+        while self.min_queue and self.min_queue[-1][1] >= low:
+            self.min_queue.pop()
+        self.min_queue.append((key, low))
+
+    def _insert(self, key, high, low):
+        if key <= self.entries[-1][0] - self.span or any(entry[0] == key for entry in self.entries):
+            return False
+        entries = sorted([*self.entries, (key, high, low)])
+        self.entries = deque(entries)
+        self.max_queue.clear()
+        self.min_queue.clear()
+        for entry in entries:
+            self._append(*entry)
+        return True
+
+    def max(self):
+        return self.max_queue[0][1] if self.max_queue else np.nan
+
+    def min(self):
+        return self.min_queue[0][1] if self.min_queue else np.nan
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DailyBars:
+    """
+    Builds daily open / close of each symbol from streamed klines of `interval`
+
+    Day is returned when its last kline arrives, days without the first kline are skipped.
+    Intervals longer than a day are not supported, add() always returns None for them.
+    """
+
+    def __init__(self, interval):
+        step = interval_to_ms(interval)
+        self.step = step if step is not None and DAY_MS % step == 0 else None
+        self.days = {}  # symbol -> [day start, open, close, started at day start]
+
+    def add(self, symbol, start, open, close):
+        """
+        Returns (day_start, open, close) if kline closes the day, else None
+        """
+        if self.step is None:
+            return None
+        day = start // DAY_MS * DAY_MS
+        bar = self.days.get(symbol)
+        if bar is None or bar[0] != day:
+            bar = [day, open, close, start == day]
+            self.days[symbol] = bar
+        else:
+            bar[2] = close
+        if start + self.step >= day + DAY_MS:
+            del self.days[symbol]
+            if bar[3]:
+                return day, bar[1], bar[2]
+        return None
+
+
+class LevelsEngine:
+    """
+    Daily resistance and support of each symbol over `window` days up to its last closed day
+
+    Resistance - max of max(open, close), support - min of min(open, close),
+    same as find_resistance_support, but updated by one day instead of refetching the window.
+    Symbols with skipped days are refilled from the cache on the next refresh, see missing().
+    """
+
+    def __init__(self, symbols, window):
+        self.symbols = list(symbols)
+        self.window = window
+        self.windows = {symbol: MonotonicWindow(window * DAY_MS) for symbol in self.symbols}
+        self.last_day = {symbol: -1 for symbol in self.symbols}
+        self.gaps = set()  # symbols with skipped days in the window
+
+    def push_day(self, symbol, day_start, open, close):
+        """
+        Adds closed day of symbol, older days are inserted into the window
+        Returns False for unknown symbol, already added day or day out of the window
+        """
+        window = self.windows.get(symbol)
+        if window is None or not window.push(day_start, max(open, close), min(open, close)):
+            return False
+        last_day = self.last_day[symbol]
+        if day_start > last_day:
+            if last_day >= 0 and day_start - last_day > DAY_MS:
+                self.gaps.add(symbol)
+            self.last_day[symbol] = day_start
+        return True
+
+    def levels(self, symbol):
+        """
+        Returns [resistance, support] or None if symbol has no days
+        """
+        window = self.windows.get(symbol)
+        if not window:
+            return None
+        return [window.max(), window.min()]
+
+    def missing(self, day_start):
+        """
+        Returns symbols without closed day day_start or with skipped days
+        """
+        return [symbol for symbol in self.symbols if self.last_day[symbol] < day_start or symbol in self.gaps]
+
+    def table(self):
+        """
+        Returns levels in joined_resistance_support format
+        {'time': 1720072835.04777, '10000000AIDOGEUSDT': [0.005384, 0.002922]}
+        """
+        levels = {'time': time.time()}
+        for symbol in self.symbols:
+            symbol_levels = self.levels(symbol)
+            if symbol_levels is not None:
+                levels[symbol] = symbol_levels
+        return levels
+
+    async def fill_from_cache(self, cache, symbols):
+        """
+        Adds closed days of symbols from KlineCache, days already added are skipped
+        Returns list of symbols which failed
+        """
+        results = await asyncio.gather(
+            *(cache.get(symbol, 'D', self.window) for symbol in symbols), return_exceptions=True
+        )
+        failed = []
+        for symbol, days in zip(symbols, results):
+            if isinstance(days, Exception):
+                failed.append(symbol)
+                continue
+            for day in days:
+                self.push_day(symbol, int(day['start']), float(day['open']), float(day['close']))
+            self.gaps.discard(symbol)
+        return failed
+
+
+class LevelsRefresher:
+    """
+    Refreshes daily levels in a background task and swaps in the new table at once
+
+    Strategy keeps reading self.table (previous day levels) while refresh runs.
+    Days not built from the stream are topped up from KlineCache with retries,
+    pairs which still failed keep their previous levels and the table is flagged as partial.
+    Failed or partial refresh is repeated not earlier than retry_after seconds later,
+    a partial refresh retries only the pairs which are still missing.
+    """
+
+    def __init__(self, engine, cache, symbols, retries=2, retry_delay=2, retry_after=60):
+        self.engine = engine
+        self.cache = cache
+        self.symbols = list(symbols)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_after = retry_after
+        self.table = None
+        self.task = None
+        self.next_attempt = 0  # monotonic time before which failed refresh is not repeated
+        self.refresh_started = None
+        self.refresh_duration = None
+        self.failed_pairs = 0
+        self.refreshes = 0
+
+    @property
+    def day(self):
+        return self.table.day if self.table is not None else -1
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def due(self, day):
+        """
+        Returns True if levels of day (ms of day start) are missing or partial and refresh can be started
+        """
+        stale = self.day < day or (self.day == day and self.table.partial)
+        return stale and not self.running and time.monotonic() >= self.next_attempt
+
+    def start(self, day):
+        """
+        Starts background refresh of levels for day (ms of day start), if it is not running yet
+        """
+        if not self.running:
+            self.task = asyncio.create_task(self.refresh(day))
+        return self.task
+
+    async def refresh(self, day):
+        self.refresh_started = time.time()
+        started = time.monotonic()
+        try:
+            failed = self.engine.missing(day - DAY_MS)
+            for attempt in range(self.retries + 1):
+                if not failed:
+                    break
+                if attempt:
+                    await asyncio.sleep(self.retry_delay)
+                # pairs which still fail keep their previous levels
+                failed = await self.engine.fill_from_cache(self.cache, failed)
+
+            levels = self.engine.table()
+            resistance, support = levels_to_arrays(levels, self.symbols)
+            self.table = LevelsTable(day, levels, resistance, support, bool(failed), failed)
+            self.failed_pairs = len(failed)
+            self.refreshes += 1
+            self.next_attempt = time.monotonic() + self.retry_after if failed else 0
+            if failed:
+                print(f"Levels are not updated, retry in {self.retry_after} s for: {', '.join(failed)}")
+        except Exception as e:
+            self.next_attempt = time.monotonic() + self.retry_after
+            print(f"Levels refresh failed, previous levels stay in use, retry in {self.retry_after} s: {e}")
+        finally:
+            self.refresh_duration = time.monotonic() - started
+        print('days_levels_created', self.metrics())
+        return self.table
+
+    def metrics(self):
+        return {
+            'day': self.day,
+            'refresh_started': self.refresh_started,
+            'refresh_duration': self.refresh_duration,
+            'failed_pairs': self.failed_pairs,
+            'partial': self.table.partial if self.table is not None else None,
+            'refreshes': self.refreshes,
+            'running': self.running,
+        }
@@ -1,66 +1,85 @@
 import asyncio
 import os
-import json
 import time
 from datetime import datetime, timezone
 from multiprocessing import Process
 
-import pandas as pd
 import numpy as np
 from dotenv import load_dotenv
 
-from api.api_market import get_lin_perp_info_asc, get_klines_asc
-from utils import split_list
-from db.futures_klines import FutureKlinesOperations
+from api.api_market import get_lin_perp_info_asc
+from api.sessions import close_sessions
 from db.settings_vars import SettingsVarsOperations
-from api.ws import SocketBybit
-from strategy import joined_resistance_support
+from api.ws import SocketManager
 from api.api_private import BybitTradeClientLinear
 from telegram import start_bot
+from transport import KlineQueue
+from kline_store import KlineStore
+from indicators import RollingSMA
+from signals import breakout_signals
+from snapshot import SnapshotWriter
+from kline_cache import KlineCache
+from levels import LevelsEngine, LevelsRefresher, DailyBars, DAY_MS
+from dispatch import OrderDispatcher, Signal
 
 load_dotenv()
 
-
-async def custom_on_message(ws, msg):
-    db_futures = FutureKlinesOperations()
-    try:
-        data = json.loads(msg.data)
-
-        if 'data' in data and data.get('data')[0].get('confirm') is True:
-            ohlc = data.get('data')[0]
-            kline = (
-                ohlc['start'],
-                str(data.get('topic').split('.')[-1]),
-                float(ohlc['open']),
-                float(ohlc['close']),
-                float(ohlc['high']),
-                float(ohlc['low']),
-                float(ohlc['volume'])
-            )
-            try:
-                await db_futures.upsert_kline(*kline)
-            except Exception as e:
-                print(f"Failed to insert data {kline}: {e}")
-    except json.JSONDecodeError as e:
-        print(f"Failed to decode JSON in custom handler: {e}")
-
-
-async def run_socket(topic, url):
-    socket = SocketBybit(url, topic, on_message=custom_on_message)
-    await socket.connect()
-
-
-def run_socket_sync(topics, url):
+# максимальное количество топиков на одно websocket соединение
+WS_TOPICS_PER_CONNECTION = int(os.getenv('ws_topics_per_connection', 200))
+# сколько секунд после первой свечи ждать свечи остальных пар по той же границе
+BATCH_GRACE = float(os.getenv('batch_grace', 0.5))
+# файл отладочного снимка свечей (пустое значение отключает запись) и минимальный период записи
+SNAPSHOT_PATH = os.getenv('snapshot_path', 'klines_snapshot.bin')
+SNAPSHOT_INTERVAL = float(os.getenv('snapshot_interval', 5))
+# каталог локального кеша свечей
+KLINE_CACHE_PATH = os.getenv('kline_cache_path', 'klines_cache')
+# сколько последних свечей хранится в файле кеша (0 - без ограничения)
+KLINE_CACHE_ROWS = int(os.getenv('kline_cache_rows', 100_000)) or None
+# сколько секунд после начала дня ждать последние свечи прошлого дня из потока
+LEVELS_ROLLOVER_GRACE = float(os.getenv('levels_rollover_grace', 5))
+# сколько ордеров по сигналам одной свечи отправляются одновременно
+ORDER_CONCURRENCY = int(os.getenv('order_concurrency', 5))
+
+
+def day_start_ms(moment):
+    """
+    Returns start of UTC day of datetime in ms
+    """
+    start = datetime(moment.year, moment.month, moment.day, tzinfo=timezone.utc)
+    return int(start.timestamp() * 1000)
+
+
+def make_on_kline(kline_queue):
+    """
+    Returns handler which sends decoded confirmed klines to the strategy process
+    """
+    async def custom_on_kline(kline):
+        try:
+            await kline_queue.put(kline)
+        except Exception as e:
+            print(f"Failed to send kline {kline}: {e}")
+
+    return custom_on_kline
+
+
+async def run_socket(topics, url, kline_queue):
+    manager = SocketManager(url, topics, on_kline=make_on_kline(kline_queue),
+                            topics_per_connection=WS_TOPICS_PER_CONNECTION)
+    await manager.run()
+
+
+def run_socket_sync(topics, url, kline_queue):
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    loop.run_until_complete(run_socket(topics, url))
+    try:
+        loop.run_until_complete(run_socket(topics, url, kline_queue))
+    finally:
+        loop.run_until_complete(close_sessions())
 
 
-async def perform_strategy(trading_pairs):
+async def perform_strategy(trading_pairs, kline_queue, short_params=None, snapshot=None):
 
     print('Strategy performance started')
-    db_futures = FutureKlinesOperations()
-    await db_futures.create_table()
 
     db_get_vars = SettingsVarsOperations()
     await db_get_vars.create_table()
@@ -111,148 +130,173 @@ async def perform_strategy(trading_pairs):
                                     tp_rate=TP_RATE, sl_rate=SL_RATE)
 
     await client.initialize_start_budget()
-
-    # получаем и сохраняем дневные уровни
-    days_levels_created = datetime(2024, 1, 1, tzinfo=timezone.utc)
-
+    # баланс и позиции приходят из приватного websocket, REST только при переподключении
+    client.start_account_stream()
+    # ордера отправляются через торговый websocket, REST - если сокет недоступен
+    client.start_trade_stream()
+    # цены для TP/SL берутся из закрытий свечей потока (поток с реального рынка,
+    # поэтому в тестовом режиме цены берутся только из снимка тикеров тестовой биржи)
+    feed_prices = not IF_TEST
+
+    # ордера по всем сигналам свечи отправляются вместе, баланс делится между лучшими сигналами
+    dispatcher = OrderDispatcher(client, max_concurrency=ORDER_CONCURRENCY)
+
+    # параметры инструментов загружаются один раз и обновляются в фоне;
+    # в тестовом режиме берутся с тестовой биржи, иначе используются полученные при старте
+    if IF_TEST or not short_params:
+        await client.instruments.refresh()
+    else:
+        client.instruments.seed(short_params)
+    client.instruments.start()
 
     # получаем исторические свечии
     print('Kline interval', KLINE_INTERVAL, 'kline period', KLINE_PERIOD)
+    # свечи берутся из локального кеша, с биржи догружается только недостающий хвост
+    kline_cache = KlineCache(KLINE_CACHE_PATH, max_rows=KLINE_CACHE_ROWS)
     tasks = [
-        asyncio.create_task(get_klines_asc(symbol, KLINE_INTERVAL, KLINE_PERIOD + 1)) for symbol in trading_pairs
+        asyncio.create_task(kline_cache.get(symbol, KLINE_INTERVAL, KLINE_PERIOD)) for symbol in trading_pairs
     ]
-    results = await asyncio.gather(*tasks)
-    results = [element.get('result') for element in results if element.get('retMsg') == 'OK']
-
-    def klines_to_df(klines, symbol):
-        columns = ['start', 'open', 'high', 'low', 'close', 'volume', 'turnover']
-        df = pd.DataFrame(klines, columns=columns)
-        df['symbol'] = symbol
-        return df
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    # хранилище последних свечей по каждой паре и скользящее среднее объема
+    klines_store = KlineStore(trading_pairs, KLINE_PERIOD * 2)
+    volume_sma = RollingSMA(trading_pairs, KLINE_PERIOD)
+
+    for symbol, klines in zip(trading_pairs, results):
+        if isinstance(klines, Exception):
+            print(f"Failed to load history for {symbol}: {klines}")
+            continue
+        for kline in klines:
+            start, volume = int(kline['start']), float(kline['volume'])
+            klines_store.append(start, symbol, float(kline['open']), float(kline['close']),
+                                float(kline['high']), float(kline['low']), volume)
+            volume_sma.update(symbol, start, volume)
+
+    # дневные уровни считаются локально: дни собираются из свечей потока,
+    # окно max/min обновляется одним днем; недостающие дни берутся из кеша
+    levels_engine = LevelsEngine(trading_pairs, WINDOW)
+    daily_bars = DailyBars(KLINE_INTERVAL)
+    levels_refresher = LevelsRefresher(levels_engine, kline_cache, klines_store.symbols)
+    # без таблицы уровней сигналы не проверить - начальная загрузка повторяется до успеха
+    while await levels_refresher.refresh(day_start_ms(datetime.now(timezone.utc))) is None:
+        await asyncio.sleep(levels_refresher.retry_after)
 
-    klines_df = pd.DataFrame(columns=['start', 'open', 'high', 'low', 'close', 'volume', 'symbol'])
 
-    for element in results:
-        symbol = element.get('symbol')
-        klines_list = element.get('list')[1:]
-        df = klines_to_df(klines_list, symbol)
-        klines_df = pd.concat([klines_df, df], ignore_index=True)
-
-    if 'turnover' in klines_df.columns:
-        klines_df = klines_df.drop('turnover', axis=1)
+    # MAIN CTRATEGY CYCLE
 
+    while True:
 
-    klines_df['start'] = pd.to_datetime(klines_df['start'], unit='ms')
-    klines_df = klines_df.set_index(klines_df['start'])
-    await asyncio.sleep(5)  # to not exeed amount of requests
+        # ждем свечи из сокетов - цикл просыпается по приходу свечей, а не по таймеру;
+        # пачка отдается когда пришли свечи всех пар по границе свечи или истекло время ожидания
+        new_klines = await kline_queue.get_batch(len(trading_pairs), grace=BATCH_GRACE, timeout=1)
+
+        # сохраняем новые свечи и обновляем SMA объема - значение считается по окну до текущей свечи
+        updated_rows = set()
+        new_rows = []
+        for kline in sorted(new_klines):
+            row = klines_store.append(*kline)
+            if row is not None:
+                volume_sma.update(kline[1], kline[0], kline[6])
+                updated_rows.add(row)
+                new_rows.append(kline)
+                if feed_prices:
+                    client.prices.update(kline[1], kline[3])
+                # последняя свеча дня закрывает дневной бар
+                day = daily_bars.add(kline[1], kline[0], kline[2], kline[3])
+                if day is not None:
+                    levels_engine.push_day(kline[1], *day)
 
+        now_utc = datetime.now(timezone.utc)
+        today = day_start_ms(now_utc)
 
-    # MAIN CTRATEGY CYCLE
+        # обновление уровней идет в фоне, до замены таблицы используются уровни прошлого дня;
+        # перед запуском ждем последние свечи прошлого дня из потока
+        # после неудачного обновления следующая попытка - не раньше чем через retry_after
+        if levels_refresher.due(today):
+            if not levels_engine.missing(today - DAY_MS) or \
+                    now_utc.timestamp() * 1000 - today >= LEVELS_ROLLOVER_GRACE * 1000:
+                levels_refresher.start(today)
 
-    while True:
+        levels_table = levels_refresher.table
+        days_levels, resistance, support = levels_table.levels, levels_table.resistance, levels_table.support
 
-        settings = {row.name: row.value for row in await db_get_vars.select_all()}
-        tm = int(settings.get('start_trade'))
-        if tm == 1:
-            TRADE_MODE = True
-        else:
-            TRADE_MODE = False
+        # если свечи получены - проверяем сигналы
+        if updated_rows:
+            settings = {row.name: row.value for row in await db_get_vars.select_all()}
+            tm = int(settings.get('start_trade'))
+            if tm == 1:
+                TRADE_MODE = True
+            else:
+                TRADE_MODE = False
+
+            # проверяем сигналы по всем обновленным парам сразу:
+            # превышение среднего объема -> пробитие уровня
+            # строки хранилища и SMA совпадают - оба построены по trading_pairs
+            rows = np.array(sorted(updated_rows), dtype=np.int64)
+            latest = klines_store.last(rows)
+            prev_sma = volume_sma.prev_sma[rows]
+            long_idx, short_idx = breakout_signals(
+                latest['open'], latest['close'], latest['volume'], prev_sma,
+                resistance[rows], support[rows], VOLUME_MULTIPLICATOR
+            )
 
-        now_utc = datetime.now(timezone.utc)
-        start_of_today_utc = datetime(now_utc.year, now_utc.month, now_utc.day, tzinfo=timezone.utc)
-
-        if days_levels_created < start_of_today_utc:
-            days_levels_created = now_utc
-            days_levels = await joined_resistance_support(trading_pairs, WINDOW, debug=False)
-            print('days_levels_created', now_utc)
-
-        # получаем из бд свежие свечи - получены из сокетов
-        new_klines = await db_futures.select_and_delete_all_klines()
-
-        # если свечи получены - преобразуем их читаемый в датафрейм и присоединяем к уже имеющимся данным
-        if not new_klines.empty:
-            new_klines_df = pd.DataFrame(new_klines)
-
-            new_klines_df['start'] = pd.to_datetime(new_klines_df['start'], unit='ms')
-            new_klines_df = new_klines_df.set_index(new_klines_df['start'])
-
-            klines_df = klines_df.sort_index().sort_values(by='symbol', kind='mergesort')
-
-            klines_df = pd.concat([klines_df, new_klines_df])
-            klines_df = klines_df.drop_duplicates()
-
-            # Рассчитываем SMA
-            klines_df['SMA'] = klines_df.groupby('symbol')['volume'].transform(
-                lambda x: x.rolling(window=KLINE_PERIOD).mean())
-
-            # cдвигаем SMA на одну строку вниз, чтобы текущее значение не учитывалось
-            # обрезаем максимальное количество строк по каждому символу
-            klines_df['SMA'] = klines_df.groupby('symbol')['SMA'].shift(1)
-            klines_df = klines_df.groupby('symbol').apply(lambda group: group.iloc[-(KLINE_PERIOD * 2):]).reset_index(
-                drop=True)
-
-
-            grouped = klines_df.groupby('symbol')
-            for symbol, group in grouped:
-                # Получаем последнюю строку в группе (самую свежую)
-                last_row = group.iloc[-1]
-
-                # Проверяем сигналы -> превышение среднего объема -> пробитие уровня
-
-                # Проверяем условие: volume > SMA * x
-                if not np.isnan(last_row['SMA']) and last_row['SMA'] != 0:
-                    if last_row['volume'] > last_row['SMA'] * VOLUME_MULTIPLICATOR:
-                        if last_row['symbol'] in new_klines_df['symbol'].values:
-                            symbol_levels = (days_levels.get(symbol))
-
-
-                            # ###################### MAIN STRATEGY LOGIC ######################
-                                  # ###################### START ######################
-                                                # #####################
-
-                            # пробитие верхнего уровня - прошлая свеча закрылась (новая открылась) ниже верхнего уровня
-                            # а последняя свеча закрылась выше уровня, то есть произошел прокол/пробитие
-                            if last_row['close'] > symbol_levels[0] and last_row['open'] < symbol_levels[0]:
-                                print('Signal for long received',
-                                      datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                                print(f"{symbol}, Close: {last_row['close']}, Volume: {last_row['volume']}, Latest SMA: {last_row['SMA']}")
-                                print(symbol_levels)
-                                if TRADE_MODE:
-                                    print('Open long')
-                                    try:
-                                        await client.place_long(symbol)
-                                    except Exception as e:
-                                        print(e)
-                            # пробитие нижнего уровня - прошлая свеча закрылась (новая открылась) выше нижнего уровня
-                            # а последняя свеча закрылась ниже уровня, то есть произошел прокол/пробитие
-                            if last_row['close'] < symbol_levels[1] and last_row['open'] > symbol_levels[1]:
-                                print('Signal for short received',
-                                      datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                                print(f"{symbol}, Close: {last_row['close']}, Volume: {last_row['volume']}, Latest SMA: {last_row['SMA']}, time: {last_row['start']}")
-                                print(symbol_levels)
-                                if TRADE_MODE:
-                                    print('Open short')
-                                    try:
-                                        await client.place_short(symbol)
-                                    except Exception as e:
-                                        print(e)
-                                                # #####################
-                                  # ###################### END ######################
-                            # ###################### MAIN STRATEGY LOGIC ######################
-
-
-            # FOR DEBUG
-            klines_df.to_csv('klines_join_data.csv', index=False)
-            print("Updated data loaded and saved to klines_join_data.csv")
-
-        await asyncio.sleep(1)
-
-
-
-def start_perform_strategy(trading_pairs):
+            # ###################### MAIN STRATEGY LOGIC ######################
+                  # ###################### START ######################
+                                # #####################
+
+            # пробитие верхнего уровня - прошлая свеча закрылась (новая открылась) ниже верхнего уровня
+            # а последняя свеча закрылась выше уровня, то есть произошел прокол/пробитие
+            signals = []
+            for i in long_idx:
+                symbol = klines_store.symbols[rows[i]]
+                print('Signal for long received',
+                      datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
+                print(f"{symbol}, Close: {latest['close'][i]}, Volume: {latest['volume'][i]}, Latest SMA: {prev_sma[i]}")
+                print(days_levels.get(symbol))
+                signals.append(Signal(symbol, 'Buy', latest['volume'][i] / prev_sma[i]))
+            # пробитие нижнего уровня - прошлая свеча закрылась (новая открылась) выше нижнего уровня
+            # а последняя свеча закрылась ниже уровня, то есть произошел прокол/пробитие
+            for i in short_idx:
+                symbol = klines_store.symbols[rows[i]]
+                print('Signal for short received',
+                      datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
+                print(f"{symbol}, Close: {latest['close'][i]}, Volume: {latest['volume'][i]}, Latest SMA: {prev_sma[i]}, time: {latest['start'][i]}")
+                print(days_levels.get(symbol))
+                signals.append(Signal(symbol, 'Sell', latest['volume'][i] / prev_sma[i]))
+
+            # сигналы ранжируются по превышению объема над SMA, ордера уходят параллельно
+            if TRADE_MODE and signals:
+                print(f"Open positions: {', '.join(f'{signal.side} {signal.symbol}' for signal in signals)}")
+                try:
+                    await dispatcher.dispatch(signals)
+                except Exception as e:
+                    print(e)
+                                # #####################
+                  # ###################### END ######################
+            # ###################### MAIN STRATEGY LOGIC ######################
+
+
+            # FOR DEBUG - новые свечи дописываются в файл в отдельном потоке
+            if snapshot is not None:
+                snapshot.submit(new_rows)
+
+
+
+def start_perform_strategy(trading_pairs, kline_queue, short_params=None):
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    loop.run_until_complete(perform_strategy(trading_pairs))
+    # отладочный снимок свечей, пишется в фоне не чаще SNAPSHOT_INTERVAL секунд
+    snapshot = None
+    if SNAPSHOT_PATH:
+        snapshot = SnapshotWriter(SNAPSHOT_PATH, min_interval=SNAPSHOT_INTERVAL)
+        snapshot.start()
+    try:
+        loop.run_until_complete(perform_strategy(trading_pairs, kline_queue, short_params, snapshot))
+    finally:
+        # дописываем очередь снимка и закрываем пул HTTP соединений процесса
+        if snapshot is not None:
+            snapshot.close()
+        loop.run_until_complete(close_sessions())
 
 
 #async def start_bot_async():
@@ -284,27 +328,30 @@ async def main():
         # собираем список торговых пар
         find_pairs = await get_lin_perp_info_asc()
         trading_pairs = find_pairs[1]
+        short_params = find_pairs[2]
+        # сессия главного процесса больше не нужна, дочерние процессы открывают свои
+        await close_sessions()
 
 
         # рыночные данные всегда собираем на реальном рынке, трейды в зависимости от настроек IF_TEST
-        url_futures = 'wss://stream.bybit.com/v5/public/linear'
+        # адрес можно заменить через bybit_ws_public_url (например, локальный simulator.py)
+        url_futures = os.getenv('bybit_ws_public_url', 'wss://stream.bybit.com/v5/public/linear')
 
         # собираем топики для сокетов
         topics = [f'kline.{KLINE_INTERVAL}.{pair}' for pair in trading_pairs]
         print(f"Total number of topics: {len(topics)}")
 
-        ws_amount = 3
-        topics_groups = split_list(topics, ws_amount)
+        # очередь свечей от сокетов к стратегии
+        kline_queue = KlineQueue()
 
-        # запускаем сокеты
+        # запускаем сокеты - все соединения в одном процессе, топики делятся по соединениям менеджером
         processes = []
-        for topic_group in topics_groups:
-            p = Process(target=run_socket_sync, args=(topic_group, url_futures))
-            processes.append(p)
-            p.start()
+        p = Process(target=run_socket_sync, args=(topics, url_futures, kline_queue))
+        processes.append(p)
+        p.start()
 
         # запускаем стратегию
-        fetch_process = Process(target=start_perform_strategy, args=(trading_pairs,))
+        fetch_process = Process(target=start_perform_strategy, args=(trading_pairs, kline_queue, short_params))
         fetch_process.start()
 
         for p in processes:
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def levels_to_arrays(days_levels, symbols):
+    """
+    Returns resistance and support arrays aligned with symbols
+    Symbols without levels get NaN, so they never signal
+    """
+    resistance = np.full(len(symbols), np.nan)
+    support = np.full(len(symbols), np.nan)
+    for row, symbol in enumerate(symbols):
+        levels = days_levels.get(symbol)
+        if levels is not None:
+            resistance[row], support[row] = levels[0], levels[1]
+    return resistance, support
+
+
+def breakout_signals(open, close, volume, prev_sma, resistance, support, multiplicator):
+    """
+    Evaluates breakout conditions for aligned arrays of symbols in one pass
+    - volume is higher than SMA of previous klines * multiplicator
+    - long: kline opened below resistance and closed above it
+    - short: kline opened above support and closed below it
+    Returns (long_indices, short_indices)
+    """
+    with np.errstate(invalid='ignore'):
+        volume_mask = ~np.isnan(prev_sma) & (prev_sma != 0) & (volume > prev_sma * multiplicator)
+        long_mask = volume_mask & (close > resistance) & (open < resistance)
+        short_mask = volume_mask & (close < support) & (open > support)
+    return np.flatnonzero(long_mask), np.flatnonzero(short_mask)
@@ -0,0 +1,416 @@
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_left, bisect_right
+from itertools import count
+
+import numpy as np
+from aiohttp import web
+from dotenv import load_dotenv
+
+from kline_cache import KlineCache
+from utils import interval_to_ms
+
+load_dotenv()
+
+
+def dumps(data):
+    # компактный json, как у биржи
+    return json.dumps(data, separators=(',', ':'))
+
+
+def fmt(value):
+    return f'{value:.10g}'
+
+
+class SyntheticFeed:
+    """
+    Random walk klines for `amount` symbols
+
+    Volume has rare spikes, so the breakout strategy gets signals.
+    """
+
+    def __init__(self, amount, interval, history=300, volatility=0.003, spike_rate=0.01, seed=None):
+        self.symbols = [f'SIM{number}USDT' for number in range(amount)]
+        self.interval = str(interval)
+        self.step = interval_to_ms(interval)
+        self.history_size = history
+        self.volatility = volatility
+        self.spike_rate = spike_rate
+        self.rng = np.random.default_rng(seed)
+        self.prices = 10 ** self.rng.uniform(-2, 4, amount)
+        self.start = None
+
+    def _klines(self):
+        amount = len(self.symbols)
+        rng = self.rng
+        open = self.prices
+        close = open * np.exp(rng.normal(0, self.volatility, amount))
+        high = np.fmax(open, close) * (1 + np.abs(rng.normal(0, self.volatility / 2, amount)))
+        low = np.fmin(open, close) * (1 - np.abs(rng.normal(0, self.volatility / 2, amount)))
+        volume = rng.lognormal(3, 0.5, amount)
+        volume[rng.random(amount) < self.spike_rate] *= 20
+        self.prices = close
+        return open, high, low, close, volume
+
+    def history(self, now_ms):
+        """
+        Returns {symbol: [(start, open, high, low, close, volume), ...]} of closed klines before now
+        """
+        first = (now_ms // self.step - self.history_size) * self.step
+        history = {symbol: [] for symbol in self.symbols}
+        for number in range(self.history_size):
+            start = first + number * self.step
+            for symbol, row in zip(self.symbols, zip(*(array.tolist() for array in self._klines()))):
+                history[symbol].append((start, *row))
+        self.start = first + self.history_size * self.step
+        return history
+
+    def next(self):
+        """
+        Returns (start, {symbol: (open, high, low, close, volume)}) of the next kline of all symbols
+        """
+        start = self.start
+        self.start += self.step
+        return start, dict(zip(self.symbols, zip(*(array.tolist() for array in self._klines()))))
+
+
+class ReplayFeed:
+    """
+    Replays klines of KlineCache in time order
+
+    Times are shifted, so the first replayed kline starts at the current kline boundary.
+    """
+
+    def __init__(self, cache, symbols, interval, history=300):
+        self.interval = str(interval)
+        self.step = interval_to_ms(interval)
+        self.history_size = history
+        self.data = {symbol: np.array(cache.load(symbol, interval)) for symbol in symbols}
+        self.symbols = [symbol for symbol in symbols if len(self.data[symbol]) > history]
+        self.batches = None
+        self.shift = 0
+
+    def history(self, now_ms):
+        first_live = min(int(self.data[symbol]['start'][self.history_size]) for symbol in self.symbols)
+        self.shift = now_ms // self.step * self.step - first_live
+        history = {}
+        batches = {}
+        for symbol in self.symbols:
+            data = self.data[symbol]
+            rows = [
+                (int(row['start']) + self.shift, float(row['open']), float(row['high']), float(row['low']),
+                 float(row['close']), float(row['volume']))
+                for row in data
+            ]
+            history[symbol] = [row for row in rows if row[0] < first_live + self.shift]
+            for row in rows[len(history[symbol]):]:
+                batches.setdefault(row[0], {})[symbol] = row[1:]
+        self.batches = iter(sorted(batches.items()))
+        return history
+
+    def next(self):
+        return next(self.batches, None)
+
+
+class ExchangeSimulator:
+    """
+    Local stand-in for the exchange endpoints used by the bot
+
+    REST: market kline / instruments-info / tickers / time, account wallet-balance,
+    position list, order create. Websockets: public linear klines, private and trade streams
+    (any key is accepted). Klines of the feed are published `rate` times per second.
+    """
+
+    def __init__(self, feed, rate=1.0, balance=10_000, max_rows=5000):
+        self.feed = feed
+        self.rate = rate
+        self.balance = balance
+        self.max_rows = max_rows
+        self.klines = {}  # symbol -> list of (start, open, high, low, close, volume)
+        self.starts = {}  # symbol -> list of starts for bisect
+        self.prices = {}
+        self.subscribers = {}  # topic -> set of websockets
+        self.published_at = {}  # symbol -> monotonic time of last kline publish
+        self.order_ids = count(1)
+        self.orders = []
+        self.latencies = []
+        self.frames = 0
+        self.batches = 0
+        self.app = self.make_app()
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/v5/market/kline', self.kline)
+        app.router.add_get('/v5/market/instruments-info', self.instruments_info)
+        app.router.add_get('/v5/market/tickers', self.tickers)
+        app.router.add_get('/v5/market/time', self.server_time)
+        app.router.add_get('/v5/account/wallet-balance', self.wallet_balance)
+        app.router.add_get('/v5/position/list', self.position_list)
+        app.router.add_post('/v5/order/create', self.order_create)
+        app.router.add_get('/v5/public/linear', self.public_ws)
+        app.router.add_get('/v5/private', self.private_ws)
+        app.router.add_get('/v5/trade', self.trade_ws)
+        return app
+
+    # ---------- state ----------
+
+    def load_history(self):
+        history = self.feed.history(int(time.time() * 1000))
+        for symbol, rows in history.items():
+            self.klines[symbol] = rows[-self.max_rows:]
+            self.starts[symbol] = [row[0] for row in self.klines[symbol]]
+            if rows:
+                self.prices[symbol] = rows[-1][4]
+
+    def add_kline(self, symbol, row):
+        rows = self.klines.setdefault(symbol, [])
+        starts = self.starts.setdefault(symbol, [])
+        rows.append(row)
+        starts.append(row[0])
+        if len(rows) > self.max_rows * 2:
+            del rows[:-self.max_rows]
+            del starts[:-self.max_rows]
+        self.prices[symbol] = row[4]
+
+    @staticmethod
+    def reply(result=None, ret_code=0, ret_msg='OK'):
+        return web.json_response({'retCode': ret_code, 'retMsg': ret_msg, 'result': result or {},
+                                  'retExtInfo': {}, 'time': int(time.time() * 1000)}, dumps=dumps)
+
+    # ---------- REST ----------
+
+    async def kline(self, request):
+        symbol = request.query.get('symbol')
+        rows = self.klines.get(symbol)
+        if rows is None:
+            return self.reply(ret_code=10001, ret_msg='Not supported symbols')
+        limit = min(int(request.query.get('limit', 200)), 1000)
+        starts = self.starts[symbol]
+        begin = bisect_left(starts, int(request.query['start'])) if 'start' in request.query else 0
+        # при ускорении время ленты уходит вперед, по REST отдаются только свечи, закрытые по часам
+        end = bisect_right(starts, time.time() * 1000 - self.feed.step)
+        if 'end' in request.query:
+            end = min(end, bisect_right(starts, int(request.query['end'])))
+        selected = rows[max(begin, end - limit):end]
+        klines = [[str(row[0]), *(fmt(value) for value in row[1:]), fmt(row[4] * row[5])]
+                  for row in reversed(selected)]
+        return self.reply({'symbol': symbol, 'category': 'linear', 'list': klines})
+
+    async def instruments_info(self, request):
+        instruments = [
+            {
+                'symbol': symbol,
+                'contractType': 'LinearPerpetual',
+                'status': 'Trading',
+                'baseCoin': symbol[:-4],
+                'quoteCoin': 'USDT',
+                'priceFilter': {'tickSize': '0.0001'},
+                'lotSizeFilter': {'qtyStep': '0.001', 'minOrderQty': '0.001'},
+            }
+            for symbol in self.klines
+        ]
+        return self.reply({'category': 'linear', 'list': instruments})
+
+    async def tickers(self, request):
+        symbol = request.query.get('symbol')
+        symbols = [symbol] if symbol else list(self.prices)
+        tickers = [{'symbol': name, 'lastPrice': fmt(self.prices[name])} for name in symbols if name in self.prices]
+        return self.reply({'category': 'linear', 'list': tickers})
+
+    async def server_time(self, request):
+        now = time.time()
+        return self.reply({'timeSecond': str(int(now)), 'timeNano': str(int(now * 1e9))})
+
+    def wallet(self):
+        balance = fmt(self.balance)
+        return {'accountType': 'UNIFIED', 'totalWalletBalance': balance,
+                'coin': [{'coin': 'USDT', 'walletBalance': balance}]}
+
+    async def wallet_balance(self, request):
+        return self.reply({'list': [self.wallet()]})
+
+    async def position_list(self, request):
+        return self.reply({'category': 'linear', 'list': []})
+
+    def create_order(self, order):
+        symbol = order.get('symbol')
+        if symbol not in self.prices:
+            return 10001, 'params error: symbol invalid', {}
+        published = self.published_at.get(symbol)
+        if published is not None:
+            # время от публикации свечи до получения ордера
+            self.latencies.append(time.monotonic() - published)
+        order_id = f'sim-{next(self.order_ids)}'
+        self.orders.append({**order, 'orderId': order_id, 'price': self.prices[symbol]})
+        return 0, 'OK', {'orderId': order_id, 'orderLinkId': order.get('orderLinkId', '')}
+
+    async def order_create(self, request):
+        ret_code, ret_msg, result = self.create_order(json.loads(await request.text()))
+        return self.reply(result, ret_code, ret_msg)
+
+    # ---------- websockets ----------
+
+    async def public_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        topics = set()
+        try:
+            async for message in ws:
+                if message.type != web.WSMsgType.TEXT:
+                    continue
+                data = json.loads(message.data)
+                if data.get('op') == 'subscribe':
+                    for topic in data.get('args', []):
+                        self.subscribers.setdefault(topic, set()).add(ws)
+                        topics.add(topic)
+                    await ws.send_str(dumps({'success': True, 'ret_msg': '', 'op': 'subscribe',
+                                             'req_id': data.get('req_id', '')}))
+                elif data.get('op') == 'ping':
+                    await ws.send_str(dumps({'success': True, 'ret_msg': 'pong', 'op': 'ping',
+                                             'req_id': data.get('req_id')}))
+        finally:
+            for topic in topics:
+                self.subscribers.get(topic, set()).discard(ws)
+        return ws
+
+    async def _private_loop(self, ws, handle):
+        async for message in ws:
+            if message.type != web.WSMsgType.TEXT:
+                continue
+            data = json.loads(message.data)
+            op = data.get('op')
+            if op == 'auth':
+                await ws.send_str(dumps({'success': True, 'retCode': 0, 'retMsg': 'OK', 'ret_msg': '', 'op': 'auth'}))
+            elif op == 'ping':
+                await ws.send_str(dumps({'op': 'pong', 'req_id': data.get('req_id'), 'args': [str(int(time.time() * 1000))]}))
+            else:
+                await handle(ws, data)
+
+    async def private_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        async def handle(ws, data):
+            if data.get('op') == 'subscribe':
+                await ws.send_str(dumps({'success': True, 'ret_msg': '', 'op': 'subscribe'}))
+                await ws.send_str(dumps({'topic': 'wallet', 'data': [self.wallet()]}))
+
+        await self._private_loop(ws, handle)
+        return ws
+
+    async def trade_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        async def handle(ws, data):
+            if data.get('op') == 'order.create':
+                ret_code, ret_msg, result = self.create_order((data.get('args') or [{}])[0])
+                await ws.send_str(dumps({'reqId': data.get('reqId'), 'retCode': ret_code, 'retMsg': ret_msg,
+                                         'op': 'order.create', 'data': result, 'header': {}}))
+
+        await self._private_loop(ws, handle)
+        return ws
+
+    # ---------- feed ----------
+
+    async def publish(self, start, klines):
+        interval = self.feed.interval
+        step = self.feed.step
+        now = int(time.time() * 1000)
+        sends = []
+        for symbol, (open, high, low, close, volume) in klines.items():
+            self.add_kline(symbol, (start, open, high, low, close, volume))
+            subscribers = self.subscribers.get(f'kline.{interval}.{symbol}')
+            if not subscribers:
+                continue
+            frame = dumps({
+                'topic': f'kline.{interval}.{symbol}',
+                'data': [{
+                    'start': start, 'end': start + step - 1, 'interval': interval,
+                    'open': fmt(open), 'close': fmt(close), 'high': fmt(high), 'low': fmt(low),
+                    'volume': fmt(volume), 'turnover': fmt(volume * close),
+                    'confirm': True, 'timestamp': now,
+                }],
+                'ts': now,
+                'type': 'snapshot',
+            })
+            self.published_at[symbol] = time.monotonic()
+            sends.extend(ws.send_str(frame) for ws in list(subscribers) if not ws.closed)
+        if sends:
+            await asyncio.gather(*sends, return_exceptions=True)
+        self.frames += len(sends)
+        self.batches += 1
+
+    async def run_feed(self):
+        period = 1 / self.rate
+        next_time = time.monotonic()
+        while True:
+            batch = self.feed.next()
+            if batch is None:
+                print('Replay finished')
+                return
+            await self.publish(*batch)
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -period:
+                # не успеваем за заданной скоростью - не копим отставание
+                next_time = time.monotonic()
+
+    async def report(self, interval=10):
+        frames, batches = self.frames, self.batches
+        while True:
+            await asyncio.sleep(interval)
+            latencies = self.latencies
+            self.latencies = []
+            latency = ''
+            if latencies:
+                latency = (f", order latency ms: median {np.median(latencies) * 1000:.1f}, "
+                           f"p99 {np.percentile(latencies, 99) * 1000:.1f}")
+            print(f"Simulator: {(self.batches - batches) / interval:.1f} klines/s per symbol, "
+                  f"{(self.frames - frames) / interval:.0f} frames/s, "
+                  f"{sum(len(s) for s in self.subscribers.values())} subscriptions, "
+                  f"{len(self.orders)} orders{latency}")
+            frames, batches = self.frames, self.batches
+
+    async def serve(self, host='127.0.0.1', port=8800):
+        self.load_history()
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        base = f'{host}:{port}'
+        print(f"Simulator with {len(self.klines)} symbols, interval {self.feed.interval}, {self.rate} klines/s")
+        print(f"bybit_rest_url=http://{base}")
+        print(f"bybit_ws_public_url=ws://{base}/v5/public/linear")
+        print(f"bybit_ws_private_url=ws://{base}/v5/private")
+        print(f"bybit_ws_trade_url=ws://{base}/v5/trade")
+        try:
+            await asyncio.gather(self.run_feed(), self.report())
+        finally:
+            await runner.cleanup()
+
+
+def main():
+    # sim_mode: synthetic - sim_symbols пар, sim_rate свечей в секунду;
+    # replay - свечи из кеша с ускорением sim_speedup
+    mode = os.getenv('sim_mode', 'synthetic')
+    interval = os.getenv('sim_interval', '5')
+    history = int(os.getenv('sim_history', 300))
+    if mode == 'replay':
+        cache = KlineCache(os.getenv('kline_cache_path', 'klines_cache'))
+        interval_path = os.path.join(cache.path, interval)
+        symbols = sorted(name[:-4] for name in os.listdir(interval_path) if name.endswith('.npy'))
+        feed = ReplayFeed(cache, symbols, interval, history=history)
+        rate = float(os.getenv('sim_speedup', 60)) * 1000 / feed.step
+    else:
+        feed = SyntheticFeed(int(os.getenv('sim_symbols', 1000)), interval, history=history)
+        rate = float(os.getenv('sim_rate', 1))
+    simulator = ExchangeSimulator(feed, rate=rate, balance=float(os.getenv('sim_balance', 10_000)))
+    asyncio.run(simulator.serve(os.getenv('sim_host', '127.0.0.1'), int(os.getenv('sim_port', 8800))))
+
+
+if __name__ == '__main__':
+    main()
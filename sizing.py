@@ -0,0 +1,353 @@
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+
+
+# precision of instrument as integers: value = units / 10 ** exponent,
+# min_steps - min order qty in qty steps (rounded up), *_f - the same step as float for the fast path
+InstrumentScales = namedtuple('InstrumentScales', [
+    'qty_step', 'qty_exp', 'min_qty', 'min_qty_exp', 'price_tick', 'price_exp',
+    'min_steps', 'qty_step_f', 'price_tick_f'
+])
+
+# ready to send order fields, values are strings
+OrderFields = namedtuple('OrderFields', ['symbol', 'side', 'qty', 'take_profit', 'stop_loss'])
+
+POW10 = [10 ** i for i in range(400)]
+
+# float quotients closer than this (relative) to a whole number of steps are floored exactly,
+# error of the float quotient is a few ulp (~1e-15)
+NEAR_STEP = 1e-13
+
+# larger quotients are floored exactly, float steps above it are not exact integers
+MAX_FAST_STEPS = 2.0 ** 52
+
+# batches shorter than this are sized order by order, numpy call overhead is larger for them
+BATCH_MIN = 64
+
+
+def to_scaled(value):
+    """
+    Returns (units, exponent) with value == units / 10 ** exponent
+    Digits are taken from str(value), same as Decimal(str(value))
+    """
+    text = value if value.__class__ is str else repr(float(value))
+    if 'e' not in text and 'E' not in text:
+        whole, _, fraction = text.partition('.')
+        return int(whole + fraction), len(fraction)
+    mantissa, _, power = text.lower().partition('e')
+    whole, _, fraction = mantissa.partition('.')
+    units = int(whole + fraction)
+    exponent = len(fraction) - int(power)
+    if exponent < 0:
+        return units * POW10[-exponent], 0
+    return units, exponent
+
+
+def format_scaled(units, exponent):
+    """
+    Returns units / 10 ** exponent as decimal string with exponent digits after the point
+    """
+    if exponent <= 0:
+        return str(units)
+    if units < 0:
+        return '-' + format_scaled(-units, exponent)
+    digits = str(units)
+    if len(digits) <= exponent:
+        digits = digits.rjust(exponent + 1, '0')
+    return digits[:-exponent] + '.' + digits[-exponent:]
+
+
+def floor_steps(value, value_exp, step, step_exp):
+    """
+    Returns how many whole steps fit into value (floor), all numbers scaled as in to_scaled
+    """
+    return value * POW10[step_exp] // (step * POW10[value_exp])
+
+
+def fast_floor(quotient):
+    """
+    Returns floor of float quotient, None if it is too close to a whole number (or too large)
+    to be sure of the float result
+    """
+    if not 0 <= quotient < MAX_FAST_STEPS:
+        return None
+    steps = math.floor(quotient)
+    margin = quotient * NEAR_STEP
+    if quotient - steps <= margin or steps + 1 - quotient <= margin:
+        return None
+    return steps
+
+
+class ScalesTable:
+    """
+    InstrumentScales of all instruments as numpy columns, row of symbol is in self.index
+    """
+
+    def __init__(self, scales):
+        self.index = {symbol: row for row, symbol in enumerate(scales)}
+        rows = list(scales.values())
+        self.qty_step = np.array([row.qty_step for row in rows], dtype=np.int64)
+        self.qty_exp = np.array([row.qty_exp for row in rows], dtype=np.int64)
+        self.min_steps = np.array([row.min_steps for row in rows], dtype=np.float64)
+        self.qty_step_f = np.array([row.qty_step_f for row in rows], dtype=np.float64)
+        self.price_tick = np.array([row.price_tick for row in rows], dtype=np.int64)
+        self.price_exp = np.array([row.price_exp for row in rows], dtype=np.int64)
+        self.price_tick_f = np.array([row.price_tick_f for row in rows], dtype=np.float64)
+
+
+def _floor_array(quotient):
+    """
+    Returns (floor of quotients, mask of quotients which need exact flooring)
+    """
+    with np.errstate(invalid='ignore'):
+        steps = np.floor(quotient)
+        margin = quotient * NEAR_STEP
+        exact = ~((quotient >= 0) & (quotient < MAX_FAST_STEPS)) \
+            | (quotient - steps <= margin) | (steps + 1 - quotient <= margin)
+    return np.where(exact, 0, steps), exact
+
+
+class SizingEngine:
+    """
+    Order quantity and TP / SL price rounding in integer instrument steps
+
+    qtyStep, tickSize and minOrderQty of each instrument are converted to integer
+    scales once. Quantity is floored to qty step, prices are floored to price tick,
+    same as Decimal(str(value)) // step. Quotients are computed in float and only
+    quotients within a few ulp of a whole step are floored with exact integer arithmetic.
+    size_batch sizes long batches with numpy in one pass over all orders.
+    `instruments` - InstrumentRegistry.
+    """
+
+    def __init__(self, instruments):
+        self.instruments = instruments
+        self.cache = {}  # Instrument -> InstrumentScales, follows registry refresh
+        self.table = None
+        self.table_source = None  # instruments dict of registry the table was built from
+        self.exact = 0  # values which needed exact flooring
+
+    def scales(self, symbol):
+        """
+        Returns InstrumentScales of symbol or None if symbol is unknown
+        """
+        instrument = self.instruments.get(symbol)
+        if instrument is None:
+            return None
+        scales = self.cache.get(instrument)
+        if scales is None:
+            qty_step, qty_exp = to_scaled(instrument.base_coin_prec)
+            min_qty, min_qty_exp = to_scaled(instrument.minOrderQty)
+            price_tick, price_exp = to_scaled(instrument.price_tick)
+            # min_qty / qty_step, rounded up
+            min_steps = -(-min_qty * POW10[qty_exp] // (qty_step * POW10[min_qty_exp]))
+            scales = InstrumentScales(qty_step, qty_exp, min_qty, min_qty_exp, price_tick, price_exp,
+                                      min_steps, qty_step / POW10[qty_exp], price_tick / POW10[price_exp])
+            self.cache[instrument] = scales
+        return scales
+
+    def scales_table(self):
+        """
+        Returns ScalesTable of all instruments of registry, rebuilt after registry refresh
+        """
+        source = self.instruments.instruments
+        if self.table is None or self.table_source is not source:
+            self.table = ScalesTable({symbol: self.scales(symbol) for symbol in source})
+            self.table_source = source
+        return self.table
+
+    def _exact_quantity_steps(self, scales, budget, price):
+        self.exact += 1
+        budget, budget_exp = to_scaled(budget)
+        price, price_exp = to_scaled(price)
+        if price <= 0:
+            return None
+        # budget / price / step = budget * 10^(price_exp + qty_exp) / (price * step * 10^budget_exp)
+        return budget * POW10[price_exp + scales.qty_exp] // (price * scales.qty_step * POW10[budget_exp])
+
+    def _exact_price(self, scales, price):
+        self.exact += 1
+        price, price_exp = to_scaled(price)
+        steps = floor_steps(price, price_exp, scales.price_tick, scales.price_exp)
+        return format_scaled(steps * scales.price_tick, scales.price_exp)
+
+    def _quantity(self, scales, budget, price):
+        price_f = float(price)
+        steps = fast_floor(float(budget) / (price_f * scales.qty_step_f)) if price_f > 0 else None
+        if steps is None:
+            steps = self._exact_quantity_steps(scales, budget, price)
+        if steps is None or steps < scales.min_steps:
+            return None
+        return format_scaled(steps * scales.qty_step, scales.qty_exp)
+
+    def _price(self, scales, price):
+        steps = fast_floor(price / scales.price_tick_f)
+        if steps is None:
+            return self._exact_price(scales, price)
+        return format_scaled(steps * scales.price_tick, scales.price_exp)
+
+    def quantity(self, symbol, budget, price):
+        """
+        Returns quantity for budget floored to qty step, None if it is below min order qty
+        """
+        scales = self.scales(symbol)
+        return None if scales is None else self._quantity(scales, budget, price)
+
+    def round_price(self, symbol, price):
+        scales = self.scales(symbol)
+        return None if scales is None else self._price(scales, float(price))
+
+    def order_fields(self, symbol, side, budget, price, tp_rate, sl_rate):
+        """
+        Returns OrderFields of market order with TP / SL, None if order can not be sized
+        """
+        scales = self.scales(symbol)
+        if scales is None:
+            return None
+        qty = self._quantity(scales, budget, price)
+        if qty is None:
+            return None
+        price = float(price)
+        if side == 'Buy':
+            take_profit, stop_loss = price * (1 + tp_rate), price * (1 - sl_rate)
+        else:
+            take_profit, stop_loss = price * (1 - tp_rate), price * (1 + sl_rate)
+        return OrderFields(symbol, side, qty, self._price(scales, take_profit), self._price(scales, stop_loss))
+
+    def size_batch(self, orders, tp_rate, sl_rate):
+        """
+        Sizes batch of orders (symbol, side, budget, price), returns list of OrderFields or None
+
+        Quotients of all orders are computed and floored as numpy arrays, only strings
+        of the result are built per order.
+        """
+        if len(orders) < BATCH_MIN:
+            return [
+                self.order_fields(symbol, side, budget, price, tp_rate, sl_rate)
+                for symbol, side, budget, price in orders
+            ]
+        table = self.scales_table()
+        symbols, sides, budgets, prices = zip(*orders)
+        rows = np.array([table.index.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+        known = rows >= 0
+        rows[~known] = 0
+        budget = np.array(budgets, dtype=np.float64)
+        price = np.array(prices, dtype=np.float64)
+        is_buy = np.array(sides) == 'Buy'
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            qty_steps, qty_exact = _floor_array(budget / (price * table.qty_step_f[rows]))
+            take_profit = np.where(is_buy, price * (1 + tp_rate), price * (1 - tp_rate))
+            stop_loss = np.where(is_buy, price * (1 - sl_rate), price * (1 + sl_rate))
+            tick = table.price_tick_f[rows]
+            tp_steps, tp_exact = _floor_array(take_profit / tick)
+            sl_steps, sl_exact = _floor_array(stop_loss / tick)
+        valid = known & (price > 0)
+        enough = qty_exact | (qty_steps >= table.min_steps[rows])
+        qty_exp = table.qty_exp[rows].tolist()
+        price_exp = table.price_exp[rows].tolist()
+        qty = list(map(format_scaled, (qty_steps.astype(np.int64) * table.qty_step[rows]).tolist(), qty_exp))
+        tp = list(map(format_scaled, (tp_steps.astype(np.int64) * table.price_tick[rows]).tolist(), price_exp))
+        sl = list(map(format_scaled, (sl_steps.astype(np.int64) * table.price_tick[rows]).tolist(), price_exp))
+        ok = (valid & enough).tolist()
+
+        # значения у границы шага пересчитываются точно
+        for i in np.flatnonzero(valid & enough & (qty_exact | tp_exact | sl_exact)).tolist():
+            scales = self.scales(symbols[i])
+            if qty_exact[i]:
+                steps = self._exact_quantity_steps(scales, budgets[i], prices[i])
+                if steps is None or steps < scales.min_steps:
+                    ok[i] = False
+                    continue
+                qty[i] = format_scaled(steps * scales.qty_step, scales.qty_exp)
+            if tp_exact[i]:
+                tp[i] = self._exact_price(scales, take_profit[i].item())
+            if sl_exact[i]:
+                sl[i] = self._exact_price(scales, stop_loss[i].item())
+
+        return [
+            OrderFields(*fields) if ok_i else None
+            for ok_i, fields in zip(ok, zip(symbols, sides, qty, tp, sl))
+        ]
+
+
+def _decimal_order_fields(instrument, side, budget, price, tp_rate, sl_rate):
+    # прежний расчет через Decimal, эталон для сравнения в benchmark
+    from decimal import Decimal
+
+    step, tick = Decimal(str(instrument.base_coin_prec)), Decimal(str(instrument.price_tick))
+    qty = Decimal(str(budget)) / Decimal(str(price)) // step * step
+    if qty < Decimal(str(instrument.minOrderQty)):
+        return None
+    price = float(price)
+    if side == 'Buy':
+        take_profit, stop_loss = price * (1 + tp_rate), price * (1 - sl_rate)
+    else:
+        take_profit, stop_loss = price * (1 - tp_rate), price * (1 + sl_rate)
+    return (float(qty), float(Decimal(str(take_profit)) // tick * tick),
+            float(Decimal(str(stop_loss)) // tick * tick))
+
+
+def benchmark(amount=100_000, batch=100, seed=1):
+    """
+    Compares per-order time of Decimal sizing, order_fields and size_batch on random orders,
+    checks that all three give the same values
+    """
+    from api.instruments import Instrument
+
+    class Registry:
+        def __init__(self, instruments):
+            self.instruments = instruments
+
+        def get(self, symbol):
+            return self.instruments.get(symbol)
+
+    rng = np.random.default_rng(seed)
+    instruments = {}
+    for number in range(500):
+        price_exp = int(rng.integers(0, 8))
+        qty_exp = int(rng.integers(-2, 4))
+        step = 10.0 ** -qty_exp
+        instruments[f'S{number}USDT'] = Instrument(step, 10.0 ** -price_exp, step * int(rng.integers(1, 5)))
+    symbols = list(instruments)
+    orders = []
+    for _ in range(amount):
+        symbol = symbols[int(rng.integers(len(symbols)))]
+        tick = instruments[symbol].price_tick
+        price = round(float(rng.uniform(100, 1e6)) * tick, 10)
+        budget = float(rng.uniform(5, 5000))
+        orders.append((symbol, 'Buy' if rng.random() < 0.5 else 'Sell', budget, price))
+
+    engine = SizingEngine(Registry(instruments))
+    engine.scales_table()
+
+    started = time.perf_counter()
+    expected = [_decimal_order_fields(instruments[order[0]], *order[1:], 0.05, 0.03) for order in orders]
+    decimal_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    single = [engine.order_fields(*order, 0.05, 0.03) for order in orders]
+    single_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batched = []
+    for i in range(0, amount, batch):
+        batched.extend(engine.size_batch(orders[i:i + batch], 0.05, 0.03))
+    batch_time = time.perf_counter() - started
+
+    def values(fields):
+        return None if fields is None else (float(fields.qty), float(fields.take_profit), float(fields.stop_loss))
+
+    mismatches = sum(
+        values(a) != b or values(c) != b for a, b, c in zip(single, expected, batched)
+    )
+    print(f"Decimal:      {decimal_time / amount * 1e6:.2f} us per order")
+    print(f"order_fields: {single_time / amount * 1e6:.2f} us per order")
+    print(f"size_batch:   {batch_time / amount * 1e6:.2f} us per order (batches of {batch})")
+    print(f"mismatches: {mismatches}, exactly floored values: {engine.exact}")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,99 @@
+import queue
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# kline record in snapshot file, field order matches transport records
+SNAPSHOT_DTYPE = np.dtype([
+    ('start', '<i8'),
+    ('symbol', 'S32'),
+    ('open', '<f8'),
+    ('close', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('volume', '<f8'),
+])
+
+
+class SnapshotWriter:
+    """
+    Appends new klines to a binary snapshot file from a background thread
+
+    submit() only puts klines into a queue, file is written by the thread
+    not more often than once in min_interval seconds.
+    File is a flat array of SNAPSHOT_DTYPE records, new rows are appended to the end.
+    """
+
+    def __init__(self, path='klines_snapshot.bin', min_interval=5.0):
+        self.path = path
+        self.min_interval = min_interval
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.written = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, klines):
+        """
+        Queues klines (tuples in transport record order) for writing
+        """
+        if klines:
+            self.queue.put(klines)
+
+    def close(self):
+        """
+        Writes queued klines and stops the thread
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        next_write = 0
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            delay = next_write - time.monotonic()
+            if item is not None and delay > 0:
+                time.sleep(delay)
+            items = [item]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = []
+            for item in items:
+                if item is None:
+                    stop = True
+                else:
+                    records.extend(item)
+            if records:
+                try:
+                    self._write(records)
+                except Exception as e:
+                    print(f"Failed to write snapshot: {e}")
+            next_write = time.monotonic() + self.min_interval
+
+    def _write(self, records):
+        data = np.array([tuple(record) for record in records], dtype=SNAPSHOT_DTYPE)
+        with open(self.path, 'ab') as f:
+            data.tofile(f)
+        self.written += len(data)
+
+
+def load_snapshot(path='klines_snapshot.bin'):
+    """
+    Returns snapshot file as dataframe (file is memory mapped, not copied into memory before conversion)
+    """
+    data = np.memmap(path, dtype=SNAPSHOT_DTYPE, mode='r')
+    df = pd.DataFrame({name: data[name] for name in SNAPSHOT_DTYPE.names})
+    df['symbol'] = df['symbol'].str.decode('ascii')
+    df['start'] = pd.to_datetime(df['start'], unit='ms')
+    return df
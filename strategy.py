@@ -33,39 +33,17 @@ async def joined_resistance_support(trading_pairs, window, debug=False):
         'time': start_time,
     }
 
-    # Initial attempt to get resistance and support levels
+    # запросы идут через общий планировщик: лимиты биржи и повторы при ошибках учитываются в нем
     tasks = [asyncio.create_task(find_resistance_support(pair, window)) for pair in trading_pairs]
     results = await asyncio.gather(*tasks, return_exceptions=True)
 
-    # Collect pairs that need retrying
-    pairs_to_retry = []
+    failed_pairs = []
     for pair, result in zip(trading_pairs, results):
         if isinstance(result, Exception):
-            pairs_to_retry.append(pair)
+            failed_pairs.append(pair)
         else:
             levels[pair] = result
 
-    # Wait 2 seconds before retrying
-    await asyncio.sleep(2)
-
-    # Perform retries sequentially for pairs that failed
-    pairs_to_retry_again = []
-    for pair in pairs_to_retry:
-        try:
-            result = await find_resistance_support(pair, window)
-            levels[pair] = result
-        except Exception:
-            pairs_to_retry_again.append(pair)
-
-    # Perform final retries sequentially for pairs that still failed
-    failed_pairs = []
-    for pair in pairs_to_retry_again:
-        try:
-            result = await find_resistance_support(pair, window)
-            levels[pair] = result
-        except Exception:
-            failed_pairs.append(pair)
-
     if failed_pairs:
         print(f"Не удалось получить уровни для: {', '.join(failed_pairs)}")
 
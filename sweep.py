@@ -0,0 +1,222 @@
+import itertools
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from backtest import MarketData, backtest, cached_symbols, daily_levels, history_cache, volume_sma
+
+
+PARAMETERS = ('kline', 'window', 'sma_period', 'multiplicator', 'tp_rate', 'sl_rate')
+
+# arrays of MarketData placed into shared memory
+SHARED_ARRAYS = ('times', 'open', 'high', 'low', 'close', 'volume', 'day_starts', 'day_open', 'day_close')
+
+
+def grid(**values):
+    """
+    Returns all combinations of parameter values
+    grid(kline=['5', '15'], window=[10, 30], ...) -> [{'kline': '5', 'window': 10, ...}, ...]
+    """
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+
+def random_search(amount, seed=None, **values):
+    """
+    Returns `amount` random combinations (without repeats) of parameter values
+    """
+    rng = random.Random(seed)
+    names = list(values)
+    total = 1
+    for options in values.values():
+        total *= len(options)
+    amount = min(amount, total)
+    chosen = set()
+    while len(chosen) < amount:
+        chosen.add(tuple(rng.randrange(len(values[name])) for name in names))
+    return [{name: values[name][index] for name, index in zip(names, combination)} for combination in sorted(chosen)]
+
+
+class SharedMarketData:
+    """
+    MarketData with its daily levels and volume SMA copied into one shared memory block
+
+    Levels (day, symbol) of each window and SMA (time, symbol) of each period are computed
+    once here, workers attach to the block by name and get numpy views, arrays are not pickled.
+    """
+
+    def __init__(self, data, windows=(), sma_periods=()):
+        # размеры массивов известны заранее, блок выделяется один раз
+        day_shape = data.day_open.shape
+        arrays = [(name, getattr(data, name).shape, getattr(data, name).dtype) for name in SHARED_ARRAYS]
+        for window in windows:
+            arrays += [(f'resistance_{window}', day_shape, np.dtype(np.float64)),
+                       (f'support_{window}', day_shape, np.dtype(np.float64))]
+        for period in sma_periods:
+            arrays.append((f'sma_{period}', data.shape, np.dtype(np.float64)))
+        layout = []
+        size = 0
+        for name, shape, dtype in arrays:
+            layout.append((name, shape, dtype.str, size))
+            size += (int(np.prod(shape)) * dtype.itemsize + 63) // 64 * 64
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        views = {
+            name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shm.buf, offset=offset)
+            for name, shape, dtype, offset in layout
+        }
+        for name in SHARED_ARRAYS:
+            views[name][...] = getattr(data, name)
+        for window in windows:
+            views[f'resistance_{window}'][...], views[f'support_{window}'][...] = daily_levels(data, window)
+        for period in sma_periods:
+            views[f'sma_{period}'][...] = volume_sma(data.volume, period)
+        del views
+        # описание блока для воркеров
+        self.spec = {
+            'name': self.shm.name,
+            'symbols': data.symbols,
+            'interval': data.interval,
+            'windows': list(windows),
+            'sma_periods': list(sma_periods),
+            'layout': layout,
+        }
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach(spec):
+    """
+    Returns (MarketData, {window: levels}, {period: sma}, shared memory block) with views
+    on shared memory in worker
+    """
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    arrays = {
+        name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+        for name, shape, dtype, offset in spec['layout']
+    }
+    data = MarketData(spec['symbols'], spec['interval'], arrays['times'], arrays['open'], arrays['high'],
+                      arrays['low'], arrays['close'], arrays['volume'],
+                      arrays['day_starts'], arrays['day_open'], arrays['day_close'])
+    levels = {window: (arrays[f'resistance_{window}'], arrays[f'support_{window}']) for window in spec['windows']}
+    sma = {period: arrays[f'sma_{period}'] for period in spec['sma_periods']}
+    return data, levels, sma, shm
+
+
+# worker state, set by _init_worker
+_data = {}
+_levels = {}
+_sma = {}
+_blocks = []
+
+
+def _init_worker(specs):
+    for interval, spec in specs.items():
+        data, levels, sma, shm = attach(spec)
+        _data[interval] = data
+        _levels[interval] = levels
+        _sma[interval] = sma
+        _blocks.append(shm)
+
+
+def evaluate(config, fee_rate=None, slippage=None):
+    """
+    Runs backtest of one configuration in worker, returns config with stats
+    """
+    interval = str(config['kline'])
+    data = _data[interval]
+    levels = _levels[interval].get(config['window'])
+    sma = _sma[interval].get(config['sma_period'])
+    kwargs = {}
+    if fee_rate is not None:
+        kwargs['fee_rate'] = fee_rate
+    if slippage is not None:
+        kwargs['slippage'] = slippage
+    result = backtest(data, config['window'], config['sma_period'], config['multiplicator'],
+                      config['tp_rate'], config['sl_rate'], levels=levels, sma=sma, **kwargs)
+    stats = dict(result.stats)
+    stats.pop('exits', None)
+    return {**config, **stats}
+
+
+def _evaluate_chunk(configs, fee_rate, slippage):
+    return [evaluate(config, fee_rate, slippage) for config in configs]
+
+
+def rank(results, metric='total_return', min_trades=10):
+    """
+    Returns results dataframe sorted by metric, configurations with less than min_trades go last
+    """
+    df = pd.DataFrame(results)
+    if df.empty:
+        return df
+    df['enough_trades'] = df['trades'] >= min_trades
+    if metric not in df:
+        df[metric] = np.nan
+    return df.sort_values(['enough_trades', metric], ascending=[False, False], ignore_index=True)
+
+
+def run_sweep(cache, symbols, configs, workers=None, metric='total_return', min_trades=10,
+              fee_rate=None, slippage=None, chunk_size=8):
+    """
+    Evaluates configurations on cached klines of symbols in a process pool, returns ranked dataframe
+
+    Data of each kline interval, its daily levels of every window and volume SMA of every period
+    are computed once and shared with workers through shared memory, workers keep no copies.
+    """
+    configs = sorted(configs, key=lambda config: tuple(str(config[name]) for name in PARAMETERS))
+    intervals = sorted({str(config['kline']) for config in configs})
+    workers = workers or os.cpu_count() or 1
+
+    shared = {}
+    try:
+        for interval in intervals:
+            started = time.time()
+            data = MarketData.from_cache(cache, symbols, interval)
+            interval_configs = [config for config in configs if str(config['kline']) == interval]
+            windows = sorted({config['window'] for config in interval_configs})
+            sma_periods = sorted({config['sma_period'] for config in interval_configs})
+            shared[interval] = SharedMarketData(data, windows, sma_periods)
+            del data
+            print(f"Loaded {interval} klines in {time.time() - started:.2f} s")
+        specs = {interval: block.spec for interval, block in shared.items()}
+
+        chunks = [configs[i:i + chunk_size] for i in range(0, len(configs), chunk_size)]
+        results = []
+        started = time.time()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(specs,)) as executor:
+            futures = [executor.submit(_evaluate_chunk, chunk, fee_rate, slippage) for chunk in chunks]
+            for number, future in enumerate(futures, 1):
+                results.extend(future.result())
+                if number % max(1, len(futures) // 10) == 0:
+                    print(f"Evaluated {len(results)} / {len(configs)} configurations, {time.time() - started:.1f} s")
+    finally:
+        for block in shared.values():
+            block.close()
+    return rank(results, metric=metric, min_trades=min_trades)
+
+
+def main():
+    cache = history_cache()
+    symbols = cached_symbols(cache, '5')
+
+    configs = grid(
+        kline=['5', '15'],
+        window=[10, 20, 30, 60],
+        sma_period=[5, 10, 20],
+        multiplicator=[2, 3, 5, 10],
+        tp_rate=[0.01, 0.02, 0.05],
+        sl_rate=[0.01, 0.02, 0.03],
+    )
+    ranked = run_sweep(cache, symbols, configs)
+    print(ranked.head(20).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import asyncio
+import queue
+import struct
+from multiprocessing import Queue
+
+
+# start, symbol, open, close, high, low, volume
+KLINE_RECORD = struct.Struct('<q32sddddd')
+KLINE_COLUMNS = ['start', 'symbol', 'open', 'close', 'high', 'low', 'volume']
+
+
+def pack_kline(start, symbol, open, close, high, low, volume):
+    """
+    Returns kline as fixed-size binary record
+    """
+    return KLINE_RECORD.pack(int(start), symbol.encode('ascii'), open, close, high, low, volume)
+
+
+def unpack_kline(record):
+    """
+    Returns kline tuple in the same order as pack_kline arguments
+    """
+    start, symbol, open, close, high, low, volume = KLINE_RECORD.unpack(record)
+    return start, symbol.rstrip(b'\x00').decode('ascii'), open, close, high, low, volume
+
+
+class KlineQueue:
+    """
+    Transport of confirmed klines from socket processes to the strategy process
+
+    Each candle is sent as a separate fixed-size record, so candles are never overwritten.
+    The queue is bounded: producers wait when it is full instead of dropping candles.
+    Instance must be created in the parent process and passed to child processes.
+    """
+
+    def __init__(self, maxsize=100_000):
+        self.queue = Queue(maxsize=maxsize)
+
+    async def put(self, kline, retry_delay=0.001):
+        record = pack_kline(*kline)
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                # backpressure - strategy process is behind, wait until it drains the queue
+                await asyncio.sleep(retry_delay)
+
+    def drain(self, limit=None):
+        """
+        Returns all klines available right now without waiting
+        """
+        klines = []
+        while limit is None or len(klines) < limit:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            klines.append(unpack_kline(record))
+        return klines
+
+    async def get(self, timeout=1.0):
+        """
+        Waits for at least one kline up to timeout seconds
+        Returns list of klines (empty list on timeout)
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            record = await loop.run_in_executor(None, self.queue.get, True, timeout)
+        except queue.Empty:
+            return []
+        klines = [unpack_kline(record)]
+        klines.extend(self.drain())
+        return klines
+
+    async def get_batch(self, expected, grace=0.5, timeout=1.0):
+        """
+        Waits for klines of the next candle boundary
+        Returns as soon as klines with the newest start are received for expected symbols
+        or grace seconds passed since the first kline of the batch (empty list on timeout)
+        """
+        klines = await self.get(timeout)
+        if not klines:
+            return []
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + grace
+        newest = None
+        received = set()
+        checked = 0
+        while True:
+            for start, symbol, *_ in klines[checked:]:
+                if newest is None or start > newest:
+                    newest = start
+                    received = set()
+                if start == newest:
+                    received.add(symbol)
+            checked = len(klines)
+            left = deadline - loop.time()
+            if len(received) >= expected or left <= 0:
+                return klines
+            klines.extend(await self.get(left))
@@ -17,6 +17,21 @@ def klines_to_df(raw_klines_store, symbol=None):
     return df_klines_store
 
 
+INTERVAL_MS = {
+    '1': 60_000, '3': 180_000, '5': 300_000, '15': 900_000, '30': 1_800_000,
+    '60': 3_600_000, '120': 7_200_000, '240': 14_400_000, '360': 21_600_000, '720': 43_200_000,
+    'D': 86_400_000, 'W': 604_800_000,
+}
+
+
+def interval_to_ms(interval):
+    """
+    Returns kline interval length in milliseconds
+    None for month interval - it has no fixed length
+    """
+    return INTERVAL_MS.get(str(interval))
+
+
 def split_list(data, size):
     """
     Gets list of data + size